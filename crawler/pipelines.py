@@ -15,6 +15,8 @@ from pathlib import Path
 
 from chatlse.postgres_engine import create_postgres_engine_from_env_sync
 from chatlse.crawler import parse_doc, generate_json_entry, generate_list_ingested_data
+from chatlse.postgres_indexes import create_fulltext_index
+from chatlse.tokens import add_token_count_column, count_tokens, format_chunk_for_rag
 
 CURRENT_DIR = Path(__file__).parents[1]
 
@@ -69,7 +71,8 @@ class ItemToPostgresPipeline:
                     url TEXT,
                     title TEXT,
                     content TEXT,
-                    date_scraped TIMESTAMP
+                    date_scraped TIMESTAMP,
+                    token_count INTEGER
                 );
             '''))
                     #embedding VECTOR(1024) is left out for now 
@@ -77,6 +80,11 @@ class ItemToPostgresPipeline:
             conn.commit()
             logging.info("Database extension and tables created successfully.")
 
+            # Stored tsvector column and GIN index used by the full-text search 
+            create_fulltext_index(conn)
+            # Token counts of chunks, used to fit sources in the prompt without re-tokenising them 
+            add_token_count_column(conn)
+
         conn.close()
 
     def process_item(self, item, spider):
@@ -151,8 +159,8 @@ class ItemToPostgresPipeline:
                     output_list = generate_json_entry(content, type, url, title, date_scraped, doc_id)
                     for idx, doc_id, chunk_id, type, url, title, content, date_scraped in output_list:
                         conn.execute(text('''
-                            INSERT INTO lse_doc (id, doc_id, chunk_id, type, url, title, content, date_scraped)
-                            VALUES (:id, :doc_id, :chunk_id, :type, :url, :title, :content, :date_scraped)
+                            INSERT INTO lse_doc (id, doc_id, chunk_id, type, url, title, content, date_scraped, token_count)
+                            VALUES (:id, :doc_id, :chunk_id, :type, :url, :title, :content, :date_scraped, :token_count)
                         '''), {
                             "id": idx,
                             "doc_id": doc_id,
@@ -161,7 +169,8 @@ class ItemToPostgresPipeline:
                             "url": url,
                             "title": title,
                             "content": content,
-                            "date_scraped": date_scraped
+                            "date_scraped": date_scraped,
+                            "token_count": count_tokens(format_chunk_for_rag(title, url, content, type))
                             #"embedding": embedding
                         })
 
@@ -7,8 +7,17 @@ from environs import Env
 from fastapi import FastAPI
 
 from .globals import global_storage
+from .prompt_registry import PromptRegistry
+from .postgres_searcher import PostgresSearcher
+from .conversation_store import create_conversation_store_from_env
+from .answer_cache import create_answer_cache_from_env
+from .intent_classifier import IntentClassifier
+from .profiler import RequestProfiler
+from .token_counter import TokenCounter
 from chatlse.clients import create_chat_client, create_embed_client
+from chatlse.embeddings import EmbeddingCache, EmbeddingService
 from chatlse.postgres_engine import create_postgres_engine_from_env
+from chatlse.reranker import RERANKER_MODEL, Reranker
 
 from .logger import logger 
 from .middleware import LogMiddleware 
@@ -22,21 +31,76 @@ async def lifespan(app: FastAPI):
 
     engine = await create_postgres_engine_from_env()
     global_storage.engine = engine
+    # One searcher (and session factory) per process, shared by all requests 
+    hnsw_ef_search = os.getenv("HNSW_EF_SEARCH")
+    global_storage.searcher = PostgresSearcher(
+        engine, 
+        ef_search=int(hnsw_ef_search) if hnsw_ef_search else None, 
+        hybrid_mode=os.getenv("HYBRID_SEARCH_MODE", "sql").lower(), 
+    )
+
+    prompts = PromptRegistry()
+    prompts.load()
+    global_storage.prompts = prompts
+
+    global_storage.conversation_store = await create_conversation_store_from_env(engine)
+    global_storage.answer_cache = await create_answer_cache_from_env(engine)
 
     chat_client, chat_model = await create_chat_client()
     global_storage.chat_client = chat_client
     global_storage.chat_model = chat_model
+    # Prompt templates are counted once here, later counts are served from the cache 
+    token_counter = TokenCounter(chat_model)
+    token_counter.warm(prompts.templates().values())
+    global_storage.token_counter = token_counter
     global_storage.to_summarise = True
     global_storage.embedding_type = os.getenv("EMBEDDING_TYPE", "title_embeddings")
     with_user_context = os.getenv("WITH_USER_CONTEXT", False)
     global_storage.with_user_context = True if with_user_context.lower()=="true" else False 
+    concurrent_pipeline = os.getenv("CONCURRENT_PIPELINE", "False")
+    global_storage.concurrent_pipeline = True if concurrent_pipeline.lower()=="true" else False 
+    latency_budget = os.getenv("LATENCY_BUDGET")
+    global_storage.latency_budget = float(latency_budget) if latency_budget else None
+    global_storage.combined_rewrite_classify = float(os.getenv("COMBINED_REWRITE_CLASSIFY", 0))
+    context_token_budget = os.getenv("CONTEXT_TOKEN_BUDGET")
+    global_storage.context_token_budget = int(context_token_budget) if context_token_budget else None
+    intent_classifier = os.getenv("INTENT_CLASSIFIER", "False")
+    if intent_classifier.lower() == "true": 
+        global_storage.intent_classifier = IntentClassifier(threshold=float(os.getenv("INTENT_CLASSIFIER_THRESHOLD", 0.9)))
     
     logger.info(f"Model Selected: {global_storage.chat_model}")
     logger.info(f"Embedding Type: {global_storage.embedding_type}")
     logger.info(f"With User Context: {global_storage.with_user_context}")
+    logger.info(f"Concurrent Pipeline: {global_storage.concurrent_pipeline}")
+    logger.info(f"Latency Budget: {global_storage.latency_budget}")
+    logger.info(f"Combined Rewrite/Classify Share: {global_storage.combined_rewrite_classify}")
+    logger.info(f"Intent Classifier: {global_storage.intent_classifier is not None}")
 
     embed_model = await create_embed_client()
-    global_storage.embed_model = embed_model
+    embed_service = EmbeddingService(
+        embed_model, 
+        max_batch_size=int(os.getenv("EMBED_MAX_BATCH_SIZE", 16)), 
+        max_wait_ms=float(os.getenv("EMBED_MAX_WAIT_MS", 5)), 
+    )
+    await embed_service.start()
+    global_storage.embed_model = embed_service
+    embedding_cache = EmbeddingCache(
+        max_size=int(os.getenv("EMBED_CACHE_SIZE", 10000)), 
+        disk_path=os.getenv("EMBED_CACHE_PATH") or None, 
+    )
+    global_storage.embedding_cache = embedding_cache
+    reranker = os.getenv("RERANKER", "False")
+    if reranker.lower() == "true": 
+        global_storage.reranker = Reranker(
+            model_name=os.getenv("RERANKER_MODEL", RERANKER_MODEL), 
+            candidates=int(os.getenv("RERANKER_CANDIDATES", 20)), 
+            cache_size=int(os.getenv("RERANKER_CACHE_SIZE", 10000)), 
+        )
+        logger.info(f"Reranker: {global_storage.reranker.model_name}")
+    profile_dir = os.getenv("PROFILE_DIR")
+    if profile_dir: 
+        global_storage.profiler = RequestProfiler(profile_dir, token=os.getenv("PROFILE_TOKEN") or None)
+        logger.info(f"Request profiling enabled, profiles are written to {profile_dir}")
     try:
         global_storage.context_window_override = int(os.getenv("CHAT_MODEL_CONTEXT_WINDOW_SIZE"))
     except:
@@ -44,6 +108,12 @@ async def lifespan(app: FastAPI):
 
     yield
 
+    await global_storage.conversation_store.close()
+    await chat_client.close()
+    await embed_service.stop()
+    embedding_cache.close()
+    if global_storage.reranker is not None: 
+        global_storage.reranker.close()
     await engine.dispose()
 
 
@@ -57,7 +127,12 @@ def create_app():
         logging.basicConfig(level=logging.WARNING)
 
     app = FastAPI(docs_url="/docs", lifespan=lifespan)
-    app.add_middleware(LogMiddleware)
+    app.add_middleware(
+        LogMiddleware, 
+        log_bodies=os.getenv("LOG_BODIES", "False").lower() == "true", 
+        max_body_bytes=int(os.getenv("LOG_BODY_MAX_BYTES", 2048)), 
+        sample_rate=float(os.getenv("LOG_BODY_SAMPLE_RATE", 1.0)), 
+    )
     logger.info("Start API ...")
 
     from . import api_routes  # noqa
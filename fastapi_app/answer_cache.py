@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+
+from pgvector.utils import to_db
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from chatlse.embeddings import normalise_query
+
+logger = logging.getLogger("ragapp")
+
+# Overrides that change which documents are retrieved, and therefore the answer
+CACHE_OVERRIDE_KEYS = [
+    "retrieval_mode", "top", "semantic_ranker", "minimum_reranker_score", "minimum_search_score", 
+    "search_candidates", "rrf_k", "vector_weight", "text_weight", 
+]
+
+
+class AnswerCache:
+    """
+    Cache of RAG answers stored in Postgres so that it is shared between workers. Entries are found by exact match
+    of the rewritten query, or by cosine similarity of its embedding above `similarity_threshold`, within the same
+    user context and retrieval overrides. An entry is dropped as soon as one of the chunks it cites has been
+    re-ingested, i.e. its `lse_doc` row is gone or its `doc_id` or `date_scraped` changed.
+
+    Entries are shared by every user with the same context, so only the answer and its sources are stored, never the
+    prompt or anything else from the conversation that produced them.
+    """
+
+    def __init__(self, engine: AsyncEngine, similarity_threshold: float = 0.95, ttl: float = 86400):
+        self.engine = engine
+        self.similarity_threshold = similarity_threshold
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    async def create_table(self):
+        async with self.engine.begin() as conn:
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+            await conn.execute(text('''
+                CREATE TABLE IF NOT EXISTS answer_cache (
+                    key TEXT PRIMARY KEY,
+                    context_key TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    query_embedding VECTOR(1024),
+                    response TEXT NOT NULL,
+                    cited_docs TEXT NOT NULL,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            '''))
+            await conn.execute(text("CREATE INDEX IF NOT EXISTS answer_cache_context_key_idx ON answer_cache (context_key)"))
+
+    @staticmethod
+    def context_key(user_context: str, overrides: dict) -> str:
+        retrieval_overrides = {key: overrides.get(key) for key in CACHE_OVERRIDE_KEYS}
+        raw = normalise_query(user_context) + json.dumps(retrieval_overrides, sort_keys=True)
+        return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def make_key(query: str, context_key: str) -> str:
+        return hashlib.sha1(f"{context_key}\x00{normalise_query(query)}".encode("utf-8")).hexdigest()
+
+    async def _is_fresh(self, conn, cited_docs: list[list]) -> bool:
+        ids = [doc[0] for doc in cited_docs]
+        rows = (await conn.execute(
+            text("SELECT id, doc_id, date_scraped FROM lse_doc WHERE id = ANY(:ids)"), {"ids": ids}
+        )).fetchall()
+        current = {id: [id, doc_id, date_scraped.isoformat() if date_scraped else None] for id, doc_id, date_scraped in rows}
+        return all(current.get(doc[0]) == doc for doc in cited_docs)
+
+    async def lookup(self, query: str, context_key: str, query_vector: list[float] | None = None) -> dict | None:
+        """
+        Returns the cached {"answer", "sources"} for `query`, or None if there is no fresh exact or near match.
+        """
+        async with self.engine.connect() as conn:
+            row = (await conn.execute(
+                text('''
+                    SELECT key, response, cited_docs, 1.0 AS similarity FROM answer_cache
+                    WHERE key = :key AND created_at > now() - make_interval(secs => :ttl)
+                '''),
+                {"key": self.make_key(query, context_key), "ttl": self.ttl},
+            )).fetchone()
+
+            if row is None and query_vector:
+                row = (await conn.execute(
+                    text('''
+                        SELECT key, response, cited_docs, 1 - (query_embedding <=> :query_embedding) AS similarity
+                        FROM answer_cache
+                        WHERE context_key = :context_key AND created_at > now() - make_interval(secs => :ttl)
+                        ORDER BY query_embedding <=> :query_embedding
+                        LIMIT 1
+                    '''),
+                    {"query_embedding": to_db(query_vector), "context_key": context_key, "ttl": self.ttl},
+                )).fetchone()
+                if row is not None and row[3] < self.similarity_threshold:
+                    row = None
+
+            if row is not None:
+                key, response, cited_docs, similarity = row
+                response = json.loads(response)
+                # Entries written before only the answer and sources were kept hold a full response, they are dropped
+                if "answer" in response and await self._is_fresh(conn, json.loads(cited_docs)):
+                    self.hits += 1
+                    logger.info(f"Answer cache hit (similarity {similarity:.3f})")
+                    return response
+                logger.info("Answer cache entry is stale or in an old format, invalidating")
+                await conn.execute(text("DELETE FROM answer_cache WHERE key = :key"), {"key": key})
+                await conn.commit()
+
+        self.misses += 1
+        return None
+
+    async def store(self, query: str, context_key: str, query_vector: list[float] | None, answer: str, sources: list[str], results: list):
+        cited_docs = [
+            [doc.id, doc.doc_id, doc.date_scraped.isoformat() if doc.date_scraped else None] for doc in results
+        ]
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text('''
+                    INSERT INTO answer_cache (key, context_key, query, query_embedding, response, cited_docs, created_at)
+                    VALUES (:key, :context_key, :query, :query_embedding, :response, :cited_docs, now())
+                    ON CONFLICT (key) DO UPDATE SET
+                        query_embedding = EXCLUDED.query_embedding,
+                        response = EXCLUDED.response,
+                        cited_docs = EXCLUDED.cited_docs,
+                        created_at = EXCLUDED.created_at
+                '''),
+                {
+                    "key": self.make_key(query, context_key),
+                    "context_key": context_key,
+                    "query": query,
+                    "query_embedding": to_db(query_vector) if query_vector else None,
+                    "response": json.dumps({"answer": answer, "sources": sources}),
+                    "cited_docs": json.dumps(cited_docs),
+                },
+            )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0}
+
+
+async def create_answer_cache_from_env(engine: AsyncEngine) -> AnswerCache | None:
+    if os.getenv("ANSWER_CACHE", "False").lower() != "true":
+        return None
+
+    answer_cache = AnswerCache(
+        engine,
+        similarity_threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+        ttl=float(os.getenv("ANSWER_CACHE_TTL", 86400)),
+    )
+    await answer_cache.create_table()
+    logger.info(f"Answer cache enabled (threshold={answer_cache.similarity_threshold})")
+    return answer_cache
@@ -1,3 +1,4 @@
+import json
 from typing import Any
 
 from pydantic import BaseModel
@@ -11,9 +12,17 @@ class Message(BaseModel):
 class ChatRequest(BaseModel):
     messages: list[Message]
     context: dict = {}
+    conversation_id: str | None = None
 
 
 class ThoughtStep(BaseModel):
     title: str
     description: Any
     props: dict = {}
+
+
+class JSONEncoder(json.JSONEncoder):
+    def default(self, o):
+        if isinstance(o, BaseModel):
+            return o.model_dump()
+        return super().default(o)
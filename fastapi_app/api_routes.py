@@ -1,11 +1,16 @@
+import json
+from collections.abc import AsyncGenerator
+
 import fastapi
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
-from .api_models import ChatRequest
+from .api_models import ChatRequest, JSONEncoder
 from .globals import global_storage
-from .postgres_searcher import PostgresSearcher
 from .logger import logger, handle_new_message
+from .conversation_store import current_conversation
+from .metrics import observe_chat, render_metrics, track_request
 
-from .rag_advanced import QueryRewriterRAG
+from .rag_advanced import QueryRewriterRAG, validate_search_overrides
 
 
 #ChatClass = random.choice([AdvancedRAGChat, QueryRewriterRAG])
@@ -15,10 +20,40 @@ logger.info(f"ChatClass: {ChatClass.__name__}")
 
 router = fastapi.APIRouter()
 
-@router.post("/chat")
-async def chat_handler(chat_request: ChatRequest, chat_class=ChatClass):
-    ragchat = chat_class(
-        searcher=PostgresSearcher(global_storage.engine),
+
+async def format_as_ndjson(r: AsyncGenerator[dict, None]) -> AsyncGenerator[str, None]:
+    try:
+        async for event in r:
+            yield json.dumps(event, cls=JSONEncoder, ensure_ascii=False) + "\n"
+    except Exception as e:
+        logger.exception("Exception while generating response stream")
+        yield json.dumps({"error": str(e)}, ensure_ascii=False) + "\n"
+
+
+async def load_conversation(chat_request: ChatRequest):
+    state = await global_storage.conversation_store.get(chat_request.conversation_id)
+    current_conversation.set(state) # Makes the conversation visible to the log formatter 
+    return state
+
+
+async def save_conversation_after(r: AsyncGenerator[dict, None], state) -> AsyncGenerator[dict, None]:
+    async for event in r:
+        yield event
+    await global_storage.conversation_store.save(state)
+
+
+async def track_stream(r: AsyncGenerator[dict, None], ragchat, endpoint: str) -> AsyncGenerator[dict, None]:
+    with track_request(endpoint):
+        async for event in r:
+            yield event
+    observe_chat(ragchat)
+
+
+def build_ragchat(state, chat_class=ChatClass):
+    return chat_class(
+        searcher=global_storage.searcher,
+        prompts=global_storage.prompts,
+        state=state,
         chat_client=global_storage.chat_client,
         chat_model=global_storage.chat_model,
         embed_model=global_storage.embed_model,
@@ -27,11 +62,22 @@ async def chat_handler(chat_request: ChatRequest, chat_class=ChatClass):
         to_summarise=global_storage.to_summarise, 
         embedding_type=global_storage.embedding_type, 
         with_user_context=global_storage.with_user_context, 
+        concurrent_pipeline=global_storage.concurrent_pipeline, 
+        embedding_cache=global_storage.embedding_cache, 
+        answer_cache=global_storage.answer_cache, 
+        reranker=global_storage.reranker, 
+        latency_budget=global_storage.latency_budget, 
+        combined_rewrite_classify=global_storage.combined_rewrite_classify, 
+        intent_classifier=global_storage.intent_classifier, 
+        token_counter=global_storage.token_counter, 
+        context_token_budget=global_storage.context_token_budget, 
     )
 
+
+def parse_chat_request(chat_request: ChatRequest, state):
     messages = [message.model_dump() for message in chat_request.messages]
     for msg in messages:
-        handle_new_message(msg['content'])  # Ensure each message is logged to history
+        handle_new_message(state, msg['content'])  # Ensure each message is logged to history
 
     logger.info(f"Received messages: {messages[0]['content']}")
     
@@ -40,8 +86,46 @@ async def chat_handler(chat_request: ChatRequest, chat_class=ChatClass):
 
     overrides = chat_request.context.get("overrides", {})
     logger.info(f"Overrides: {overrides}")
+    try:
+        overrides = validate_search_overrides(overrides)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e))
+
+    return messages, user_info, overrides
+
+
+@router.post("/chat")
+async def chat_handler(chat_request: ChatRequest, chat_class=ChatClass, x_profile: str | None = fastapi.Header(default=None)):
+    with track_request("/chat"):
+        state = await load_conversation(chat_request)
+        ragchat = build_ragchat(state, chat_class)
+        messages, user_info, overrides = parse_chat_request(chat_request, state)
 
-    response = await ragchat.run(messages, user_info=user_info, overrides=overrides)
+        profiler = global_storage.profiler
+        if profiler is not None and profiler.is_requested(x_profile, overrides): 
+            response, profile_id = await profiler.run(ragchat.run(messages, user_info=user_info, overrides=overrides))
+            response["profile_id"] = profile_id
+        else: 
+            response = await ragchat.run(messages, user_info=user_info, overrides=overrides)
+        await global_storage.conversation_store.save(state)
+    observe_chat(ragchat)
     logger.info(f"Response: {response['choices'][0]['message']['content']}")
 
     return response
+
+
+@router.post("/chat/stream")
+async def chat_stream_handler(chat_request: ChatRequest, chat_class=ChatClass):
+    state = await load_conversation(chat_request)
+    ragchat = build_ragchat(state, chat_class)
+    messages, user_info, overrides = parse_chat_request(chat_request, state)
+
+    result = save_conversation_after(ragchat.run_stream(messages, user_info=user_info, overrides=overrides), state)
+    result = track_stream(result, ragchat, "/chat/stream")
+    return StreamingResponse(format_as_ndjson(result), media_type="application/x-ndjson")
+
+
+@router.get("/metrics")
+async def metrics_handler():
+    # Prometheus text exposition format 
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
@@ -0,0 +1,79 @@
+from dataclasses import dataclass, field, replace
+
+from chatlse.tokens import format_chunk_for_rag
+
+from .token_counter import TokenCounter
+
+MIN_OVERLAP_CHARS = 20 # Shortest shared text treated as chunk overlap rather than coincidence
+
+
+@dataclass
+class PackedDocument:
+    """
+    Retrieved chunks of one document, under a single header in the prompt.
+    """
+    doc_id: str
+    title: str
+    url: str
+    type: str
+    chunks: list = field(default_factory=list)
+
+    def merged_content(self) -> str:
+        """
+        Joins the chunks in document order. Adjacent chunks share the splitter's overlap, which is only kept once,
+        gaps between non-adjacent chunks are marked with an ellipsis.
+        """
+        chunks = sorted(self.chunks, key=lambda doc: int(doc.chunk_id))
+        content = chunks[0].content
+        for previous, chunk in zip(chunks, chunks[1:]):
+            if int(chunk.chunk_id) == int(previous.chunk_id) + 1:
+                content = merge_overlapping(content, chunk.content)
+            else:
+                content += "\n...\n" + chunk.content
+        return content
+
+    def to_str_for_rag(self) -> str:
+        return f"[{self.doc_id}]: {format_chunk_for_rag(self.title, self.url, self.merged_content(), self.type)}\n\n"
+
+
+def merge_overlapping(first: str, second: str) -> str:
+    """
+    Appends `second` to `first` without the text at the start of `second` that repeats the end of `first`.
+    """
+    head = second[:MIN_OVERLAP_CHARS]
+    start = first.find(head, max(0, len(first) - len(second)))
+    while start != -1:
+        if second.startswith(first[start:]):
+            return first + second[len(first) - start:]
+        start = first.find(head, start + 1)
+    return first + " " + second
+
+
+def pack_context(results: list, token_counter: TokenCounter, max_tokens: int | None = None) -> tuple[list[PackedDocument], list, int]:
+    """
+    Groups `results` (best first) by document and keeps the best chunks whose tokens fit in `max_tokens`. The first
+    chunk of a document is counted from its cached token count, a document with more chunks from its merged text, so
+    the overlap between adjacent chunks is only counted once. Returns the packed documents ordered by their best
+    chunk, the chunks that were kept, and the estimated token count of the packed sources.
+    """
+    documents: dict[str, PackedDocument] = {}
+    document_tokens: dict[str, int] = {}
+    kept = []
+    for doc in results:
+        document = documents.get(doc.doc_id)
+        if document is None:
+            document = PackedDocument(doc.doc_id, doc.title, doc.url, doc.type, [doc])
+            tokens = token_counter.count_chunk(doc) + token_counter.count_text(f"[{doc.doc_id}]: ") + 1
+        else:
+            document = replace(document, chunks=document.chunks + [doc])
+            tokens = token_counter.count_text(document.to_str_for_rag())
+
+        total_tokens = sum(document_tokens.values()) - document_tokens.get(doc.doc_id, 0) + tokens
+        if max_tokens is not None and total_tokens > max_tokens:
+            continue
+
+        documents[doc.doc_id] = document
+        document_tokens[doc.doc_id] = tokens
+        kept.append(doc)
+
+    return list(documents.values()), kept, sum(document_tokens.values())
@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import time
+import uuid
+from collections import OrderedDict
+from contextvars import ContextVar
+from dataclasses import asdict, dataclass, field
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+logger = logging.getLogger("ragapp")
+
+MAX_RAG_RESULTS = 3 # Only the most recent RAG result is used for follow up questions
+MAX_MESSAGE_HISTORY = 6
+
+
+@dataclass
+class ConversationState:
+    """
+    State that has to survive between the turns of one conversation.
+    """
+    conversation_id: str
+    rag_results: list[str] = field(default_factory=list)
+    user_context: str = ""
+    requires_clarification: bool = False
+    message_history: list[str] = field(default_factory=list)
+
+    def add_rag_result(self, content: str):
+        self.rag_results.append(content)
+        del self.rag_results[:-MAX_RAG_RESULTS]
+
+    def add_message(self, message: str):
+        self.message_history.append(message)
+        del self.message_history[:-MAX_MESSAGE_HISTORY]
+
+    def to_dict(self):
+        return asdict(self)
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(**{key: value for key, value in data.items() if key in cls.__dataclass_fields__})
+
+
+# State of the conversation handled by the current request, used by the log formatter
+current_conversation: ContextVar[ConversationState | None] = ContextVar("current_conversation", default=None)
+
+
+def new_conversation_id() -> str:
+    return uuid.uuid4().hex
+
+
+class ConversationStore:
+    """
+    Base class of the conversation state backends. `get` never fails: unknown or expired ids get a fresh state.
+    """
+
+    async def get(self, conversation_id: str | None) -> ConversationState:
+        raise NotImplementedError
+
+    async def save(self, state: ConversationState):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Per-process store with LRU eviction above `max_size` conversations and TTL eviction of idle conversations.
+    Only suitable for a single uvicorn worker.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._states: OrderedDict[str, tuple[float, ConversationState]] = OrderedDict()
+
+    def _evict(self, now: float):
+        # Entries are kept in last-access order, so expired entries are always at the front
+        while self._states:
+            conversation_id, (last_access, _) = next(iter(self._states.items()))
+            if now - last_access < self.ttl and len(self._states) <= self.max_size:
+                break
+            del self._states[conversation_id]
+
+    def _touch(self, state: ConversationState, now: float):
+        self._states[state.conversation_id] = (now, state)
+        self._states.move_to_end(state.conversation_id)
+
+    async def get(self, conversation_id: str | None) -> ConversationState:
+        now = time.monotonic()
+        self._evict(now)
+        if conversation_id and conversation_id in self._states:
+            _, state = self._states[conversation_id]
+            self._touch(state, now)
+            return state
+        return ConversationState(conversation_id=conversation_id or new_conversation_id())
+
+    async def save(self, state: ConversationState):
+        now = time.monotonic()
+        self._touch(state, now)
+        self._evict(now)
+
+
+class PostgresConversationStore(ConversationStore):
+    """
+    Stores conversation state in the `conversation_state` table so that several uvicorn workers share it.
+    Expired rows are deleted at most once every `cleanup_interval` seconds.
+    """
+
+    def __init__(self, engine: AsyncEngine, ttl: float = 3600, cleanup_interval: float = 300):
+        self.engine = engine
+        self.ttl = ttl
+        self.cleanup_interval = cleanup_interval
+        self._last_cleanup = 0.0
+
+    async def create_table(self):
+        async with self.engine.begin() as conn:
+            await conn.execute(text('''
+                CREATE TABLE IF NOT EXISTS conversation_state (
+                    conversation_id TEXT PRIMARY KEY,
+                    state TEXT NOT NULL,
+                    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                );
+            '''))
+
+    async def get(self, conversation_id: str | None) -> ConversationState:
+        if conversation_id:
+            async with self.engine.connect() as conn:
+                row = (await conn.execute(
+                    text('''
+                        SELECT state FROM conversation_state
+                        WHERE conversation_id = :conversation_id AND updated_at > now() - make_interval(secs => :ttl)
+                    '''),
+                    {"conversation_id": conversation_id, "ttl": self.ttl},
+                )).fetchone()
+            if row:
+                return ConversationState.from_dict(json.loads(row[0]))
+        return ConversationState(conversation_id=conversation_id or new_conversation_id())
+
+    async def save(self, state: ConversationState):
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                text('''
+                    INSERT INTO conversation_state (conversation_id, state, updated_at)
+                    VALUES (:conversation_id, :state, now())
+                    ON CONFLICT (conversation_id) DO UPDATE SET state = EXCLUDED.state, updated_at = EXCLUDED.updated_at
+                '''),
+                {"conversation_id": state.conversation_id, "state": json.dumps(state.to_dict())},
+            )
+
+            now = time.monotonic()
+            if now - self._last_cleanup >= self.cleanup_interval:
+                self._last_cleanup = now
+                await conn.execute(
+                    text("DELETE FROM conversation_state WHERE updated_at < now() - make_interval(secs => :ttl)"),
+                    {"ttl": self.ttl},
+                )
+
+
+async def create_conversation_store_from_env(engine: AsyncEngine) -> ConversationStore:
+    backend = os.getenv("CONVERSATION_STORE", "memory").lower()
+    ttl = float(os.getenv("CONVERSATION_STORE_TTL", 3600))
+
+    if backend == "postgres":
+        store = PostgresConversationStore(engine, ttl=ttl)
+        await store.create_table()
+    elif backend == "memory":
+        store = InMemoryConversationStore(max_size=int(os.getenv("CONVERSATION_STORE_MAX_SIZE", 1000)), ttl=ttl)
+    else:
+        raise ValueError('CONVERSATION_STORE must be in ["memory", "postgres"]')
+
+    logger.info(f"Conversation store: {backend}")
+    return store
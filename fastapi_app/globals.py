@@ -1,22 +1,31 @@
 class Global:
     def __init__(self):
         self.engine = None
+        self.searcher = None
+        self.prompts = None
+        self.token_counter = None
         self.chat_client = None
         self.embed_client = None
         self.chat_model = None
         self.embed_model = None
+        self.embedding_cache = None
+        self.answer_cache = None
+        self.reranker = None
         self.embed_dimensions = None
         self.chat_deployment = None
         self.embed_deployment = None
         self.context_window_override = None 
         self.to_summarise = None
-        self.rag_results = []
-        self.user_context = None
-        self.requires_clarification = None
+        self.conversation_store = None
         self.chat_class = None 
-        self.message_history = []
         self.embedding_type = None
         self.with_user_context=None
+        self.concurrent_pipeline = None
+        self.latency_budget = None
+        self.combined_rewrite_classify = None
+        self.intent_classifier = None
+        self.context_token_budget = None
+        self.profiler = None
 
 
 global_storage = Global()
@@ -0,0 +1,84 @@
+import re
+from dataclasses import dataclass
+
+from chatlse.embeddings import normalise_query
+
+# Words a message may consist of to be a pure greeting or farewell, anything else lowers the confidence
+GREETING_WORDS = {
+    "hi", "hello", "hey", "hiya", "howdy", "yo", "sup", "morning", "afternoon", "evening", "good", "there",
+    "how", "are", "you", "is", "it", "going", "what's", "whats", "up", "greetings",
+}
+FAREWELL_WORDS = {
+    "bye", "goodbye", "byebye", "cya", "see", "you", "later", "soon", "thanks", "thank", "thx", "ty", "cheers",
+    "great", "perfect", "ok", "okay", "cool", "that's", "thats", "all", "for", "your", "help", "very", "much", "so",
+    "good", "night", "have", "a", "nice", "day", "awesome", "brilliant", "appreciate", "it", "got", "i",
+}
+# Words that have to appear for a message to count as a greeting or farewell at all
+GREETING_MARKERS = {"hi", "hello", "hey", "hiya", "howdy", "yo", "sup", "greetings", "morning", "afternoon", "evening"}
+FAREWELL_MARKERS = {"bye", "goodbye", "byebye", "cya", "later", "thanks", "thank", "thx", "ty", "cheers", "night"}
+
+# Requests that are usually not about LSE administration, answered like the model's out-of-scope reply unless they
+# mention one of LSE_KEYWORDS
+OUT_OF_SCOPE_PATTERNS = [
+    re.compile(pattern) for pattern in [
+        r"^(tell|give) me a joke",
+        r"^write (me )?(a|an) (poem|song|story|haiku)",
+        r"^what('s| is) the weather",
+        r"^(who|which team) (won|will win) the",
+    ]
+]
+
+# Words that tie a query to LSE, e.g. "what is the weather like at lse graduation" is left to the model
+LSE_KEYWORDS = {
+    "lse", "london", "school", "economics", "campus", "graduation", "student", "students", "course", "courses",
+    "exam", "exams", "term", "library", "department", "accommodation", "halls", "society", "societies", "union",
+    "varsity", "lecture", "lectures", "seminar", "seminars",
+}
+
+TEMPLATED_RESPONSES = {
+    "greeting": "Hello! I'm an assistant at the London School of Economics. How can I help you today?",
+    "farewell": "Thank you for using ChatLSE. Goodbye!",
+    "out_of_scope": "Sorry, but I cannot assist you with this query as it is out of my scope.",
+}
+
+
+@dataclass
+class IntentDecision:
+    intent: str | None # "greeting", "farewell", "out_of_scope" or None if no rule matched
+    confidence: float
+
+
+class IntentClassifier:
+    """
+    Rule-based classifier for the obvious cases (pure greetings, thanks and farewells, and a few clearly out-of-scope
+    requests) that can be answered from TEMPLATED_RESPONSES without calling the model. The confidence of a greeting
+    or farewell is the share of the message's words that are greeting or farewell words, so "hi" is certain but
+    "hi, how do I apply for housing" is not. Out-of-scope patterns are only certain for queries without any of
+    LSE_KEYWORDS. Decisions below `threshold` are left to the LLM classification.
+    """
+
+    def __init__(self, threshold: float = 0.9, max_words: int = 10):
+        self.threshold = threshold
+        self.max_words = max_words # Longer messages always go to the model
+
+    def classify(self, query: str) -> IntentDecision:
+        text = normalise_query(query)
+        words = re.findall(r"[a-z']+", text)
+        if not words or len(words) > self.max_words:
+            return IntentDecision(None, 0.0)
+
+        if any(pattern.search(text) for pattern in OUT_OF_SCOPE_PATTERNS):
+            return IntentDecision("out_of_scope", 0.0 if LSE_KEYWORDS.intersection(words) else 1.0)
+
+        decisions = []
+        for intent, vocabulary, markers in [
+            ("farewell", FAREWELL_WORDS, FAREWELL_MARKERS),
+            ("greeting", GREETING_WORDS, GREETING_MARKERS),
+        ]:
+            if markers.intersection(words):
+                decisions.append(IntentDecision(intent, sum(word in vocabulary for word in words) / len(words)))
+
+        return max(decisions, key=lambda decision: decision.confidence, default=IntentDecision(None, 0.0))
+
+    def is_confident(self, decision: IntentDecision) -> bool:
+        return decision.intent is not None and decision.confidence >= self.threshold
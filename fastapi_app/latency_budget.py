@@ -0,0 +1,43 @@
+import time
+
+# Share of the total budget each stage may use before it is skipped. Generation is not budgeted, the budget
+# covers everything the user waits for before the first answer token.
+STAGE_SHARES = {
+    "summarise": 0.3,
+    "rewrite": 0.3,
+    "classify": 0.3,
+    "rewrite_classify": 0.5,
+    "retrieve": 0.4,
+    "search": 0.3,
+    "rerank": 0.2,
+    "vector_search": 1.0, # Fallback of a hybrid search that timed out, gets whatever is left
+}
+
+
+class LatencyBudget:
+    """
+    Deadline of the stages that run before answer generation, started when the request arrives. Each stage gets a
+    timeout of its share of the total budget, capped by what is left of it. A budget of None never runs out.
+    """
+
+    def __init__(self, budget: float | None = None):
+        self.budget = budget
+        self.start = time.monotonic()
+
+    def remaining(self) -> float | None:
+        if self.budget is None:
+            return None
+        return self.budget - (time.monotonic() - self.start)
+
+    def stage_timeout(self, stage: str) -> float | None:
+        remaining = self.remaining()
+        if remaining is None:
+            return None
+        return max(0.0, min(self.budget * STAGE_SHARES.get(stage, 1.0), remaining))
+
+    def is_short_for(self, stage: str) -> bool:
+        """
+        True if less than the stage's share of the budget is left.
+        """
+        remaining = self.remaining()
+        return remaining is not None and remaining < self.budget * STAGE_SHARES.get(stage, 1.0)
@@ -1,9 +1,13 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 import sys 
 import os
 from dotenv import load_dotenv
 from logtail import LogtailHandler
 from .globals import global_storage
+from .conversation_store import current_conversation
 
 #load environment variables
 load_dotenv()
@@ -15,26 +19,48 @@ logger = logging.getLogger("ragapp")
 
 # create formatter 
 
-class CustomFormatter(logging.Formatter):
-    def format(self, record):
+class ConversationContextFilter(logging.Filter):
+    """
+    Copies the model and the current conversation onto the record while still in the request's context, the records
+    are formatted later by the listener thread where `current_conversation` is not set.
+    """
+    def filter(self, record):
         record.model = getattr(global_storage, 'chat_model', 'No Model Selected')
         record.summariser = getattr(global_storage, 'to_summarise', False)
-        record.user_context = getattr(global_storage, 'user_context', {})
+        state = current_conversation.get()
+        record.user_context = state.user_context if state else {}
         record.chat_class = getattr(global_storage, 'chat_class', None)
-        record.message_history = " | ".join(global_storage.message_history)  # Join messages into a single string
-        format_string = "%(asctime)s - %(levelname)s - Model: %(model)s - Summariser: %(summariser)s - Messages: %(message_history)s - User context: %(user_context)s - Chat Class: %(chat_class)s"
-        formatter = logging.Formatter(format_string)
-        return formatter.format(record)
+        record.messages = list(state.message_history) if state else []
+        return True
 
-def handle_new_message(message):
-    global_storage.message_history.append(message)
-    
-    if len(global_storage.message_history) > 6: 
-        global_storage.message_history = global_storage.message_history[-6:]
 
+class CustomFormatter(logging.Formatter):
+    def format(self, record):
+        record.message_history = " | ".join(getattr(record, 'messages', []))  # Join messages into a single string
+        return super().format(record)
+
+def handle_new_message(state, message):
+    state.add_message(message)
 
 
-formatter = CustomFormatter("%(asctime)s - %(levelname)s - Model: %(model)s - Summariser: %(summariser)s - %(message)s - User context: %(user_context)s - Chat Class: %(chat_class)s")
+
+formatter = CustomFormatter("%(asctime)s - %(levelname)s - Model: %(model)s - Summariser: %(summariser)s - Messages: %(message_history)s - User context: %(user_context)s - Chat Class: %(chat_class)s")
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Puts records on a bounded queue without blocking, records that do not fit are dropped and counted so that a slow
+    log sink never slows down requests.
+    """
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropcount = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropcount += 1
 
 # create ExcludeWarningsFilter class to remove unneccessary logs (e.g. "defaulting to Cl100k")
 class ExcludeWarningsAndHTTPFilter(logging.Filter):
@@ -70,22 +96,42 @@ class ExcludeWarningsAndHTTPFilter(logging.Filter):
 
 # stream_handler = logging.StreamHandler(sys.stdout)
 file_handler = logging.FileHandler('app.log')
-better_stack_handler = LogtailHandler(source_token = token)
+# Logtail ships records in batches from its own thread and drops them when its buffer is full
+better_stack_handler = LogtailHandler(
+    source_token = token, 
+    buffer_capacity=int(os.getenv('LOGTAIL_BUFFER_CAPACITY', 1000)), 
+    flush_interval=float(os.getenv('LOGTAIL_FLUSH_INTERVAL', 2)), 
+    drop_extra_events=True, 
+)
 
 # set formatters
 # stream_handler.setFormatter(formatter)
 file_handler.setFormatter(formatter)
 
-# add handlers to the logger
-logger.handlers = [file_handler, better_stack_handler]
+# the logger only enqueues records, the handlers run in the listener thread
+queue_handler = DroppingQueueHandler(queue.Queue(maxsize=int(os.getenv('LOG_QUEUE_SIZE', 10000))))
+listener = logging.handlers.QueueListener(queue_handler.queue, file_handler, better_stack_handler, respect_handler_level=True)
+logger.handlers = [queue_handler]
 
 # set log-level
 
 logger.setLevel(logging.INFO)
 exclude_warnings_filter = ExcludeWarningsAndHTTPFilter()
 logger.addFilter(exclude_warnings_filter)
+logger.addFilter(ConversationContextFilter())
 
 # ensuring that exclude_warnings_filter runs on all three handlers
 # stream_handler.addFilter(exclude_warnings_filter)
 file_handler.addFilter(exclude_warnings_filter)
-better_stack_handler.addFilter(exclude_warnings_filter)
\ No newline at end of file
+better_stack_handler.addFilter(exclude_warnings_filter)
+
+listener.start()
+atexit.register(listener.stop)
+
+
+def log_stats() -> dict:
+    return {
+        "queued": queue_handler.queue.qsize(),
+        "dropped": queue_handler.dropcount,
+        "logtail_dropped": better_stack_handler.dropcount,
+    }
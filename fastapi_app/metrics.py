@@ -0,0 +1,194 @@
+import math
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from .globals import global_storage
+from .logger import log_stats
+
+# Seconds, from a cache hit to a long generation on CPU
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, math.inf)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def escape_label(label) -> str:
+    return str(label).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_sample(name: str, labels: dict, value: float) -> str:
+    if not labels:
+        return f"{name} {format_value(value)}"
+    label_str = ",".join(f'{key}="{escape_label(label)}"' for key, label in labels.items())
+    return f"{name}{{{label_str}}} {format_value(value)}"
+
+
+class Counter:
+    """
+    Metric in the Prometheus text format, with one value per combination of `labelnames`.
+    """
+    type = "counter"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = ()):
+        self.name = name
+        self.description = description
+        self.labelnames = labelnames
+        self.values = defaultdict(float)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount: float = 1.0, **labels):
+        self.values[self.key(labels)] += amount
+
+    def samples(self):
+        for key, value in self.values.items():
+            yield self.name, dict(zip(self.labelnames, key)), value
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.type}"]
+        lines += [format_sample(name, labels, value) for name, labels, value in self.samples()]
+        return lines
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.values[self.key(labels)] -= amount
+
+    def set(self, value: float, **labels):
+        self.values[self.key(labels)] = value
+
+
+class Histogram(Counter):
+    type = "histogram"
+
+    def __init__(self, name: str, description: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        super().__init__(name, description, labelnames)
+        self.buckets = buckets
+        self.counts = defaultdict(lambda: [0] * len(self.buckets))
+        self.sums = defaultdict(float)
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+        counts = self.counts[key]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.sums[key] += value
+
+    def samples(self):
+        for key, counts in self.counts.items():
+            labels = dict(zip(self.labelnames, key))
+            for bound, count in zip(self.buckets, counts):
+                yield f"{self.name}_bucket", {**labels, "le": format_value(bound)}, count
+            yield f"{self.name}_sum", labels, self.sums[key]
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+REQUESTS = Counter("ragapp_requests_total", "Chat requests by endpoint and outcome.", ("endpoint", "status"))
+REQUEST_DURATION = Histogram("ragapp_request_duration_seconds", "Duration of chat requests, until the last streamed token.", ("endpoint",))
+IN_FLIGHT = Gauge("ragapp_requests_in_flight", "Chat requests being handled.", ("endpoint",))
+STAGE_DURATION = Histogram("ragapp_stage_duration_seconds", "Duration of the RAG pipeline stages (nested stages are included in their parent), by rewrite/classify arm.", ("stage", "arm"))
+TOKENS = Counter("ragapp_tokens_total", "Prompt and completion tokens reported by the chat model, by pipeline stage and rewrite/classify arm.", ("stage", "kind", "arm"))
+SKIPPED_STAGES = Counter("ragapp_skipped_stages_total", "Stages skipped because the latency budget ran out.", ("stage",))
+ANSWERS = Counter("ragapp_answers_total", "Answers by source (the model, the answer cache or the intent classifier templates) and rewrite/classify arm.", ("source", "arm"))
+
+METRICS = [REQUESTS, REQUEST_DURATION, IN_FLIGHT, STAGE_DURATION, TOKENS, SKIPPED_STAGES, ANSWERS]
+
+
+@contextmanager
+def track_request(endpoint: str):
+    """
+    Counts a chat request as in flight while the block runs, then records its duration and outcome.
+    """
+    IN_FLIGHT.inc(endpoint=endpoint)
+    start = time.monotonic()
+    status = "error"
+    try:
+        yield
+        status = "ok"
+    finally:
+        IN_FLIGHT.dec(endpoint=endpoint)
+        REQUEST_DURATION.observe(time.monotonic() - start, endpoint=endpoint)
+        REQUESTS.inc(endpoint=endpoint, status=status)
+
+
+def observe_chat(ragchat):
+    """
+    Records the stage timings and token usage collected by a RAG chat object during one request, labelled with its
+    rewrite/classify A/B arm ("none" when the request was not bucketed) so that the arms can be compared.
+    """
+    arm = ragchat.rewrite_classify_arm or "none"
+    for stage, seconds in ragchat.timings.items():
+        STAGE_DURATION.observe(seconds, stage=stage, arm=arm)
+    for stage, usage in ragchat.token_usage.items():
+        for kind, tokens in usage.items():
+            TOKENS.inc(tokens, stage=stage, kind=kind.removesuffix("_tokens"), arm=arm)
+    for stage in ragchat.skipped_stages:
+        SKIPPED_STAGES.inc(stage=stage)
+
+    if ragchat.cached_response is not None:
+        ANSWERS.inc(source="answer_cache", arm=arm)
+    elif ragchat.intent_response is not None:
+        ANSWERS.inc(source="intent", arm=arm)
+    else:
+        ANSWERS.inc(source="model", arm=arm)
+
+
+def component_metrics() -> list[Counter]:
+    """
+    Gauges and counters read from the `stats()` of the process-wide caches, chat client and database pool at scrape time.
+    """
+    cache_lookups = Counter("ragapp_cache_lookups_total", "Cache lookups by cache and result.", ("cache", "result"))
+    cache_hit_rate = Gauge("ragapp_cache_hit_rate", "Share of cache lookups that were hits since startup.", ("cache",))
+    for cache, component in [
+        ("embedding", global_storage.embedding_cache),
+        ("answer", global_storage.answer_cache),
+        ("reranker", global_storage.reranker),
+    ]:
+        if component is None:
+            continue
+        stats = component.stats()
+        cache_lookups.inc(stats["hits"] + stats.get("disk_hits", 0), cache=cache, result="hit")
+        cache_lookups.inc(stats["misses"], cache=cache, result="miss")
+        cache_hit_rate.set(stats["hit_rate"], cache=cache)
+    metrics = [cache_lookups, cache_hit_rate]
+
+    if hasattr(global_storage.chat_client, "stats"):
+        stats = global_storage.chat_client.stats()
+        chat_in_flight = Gauge("ragapp_chat_completions_in_flight", "Chat completions sent to the model and not finished.")
+        chat_in_flight.set(stats["in_flight"])
+        chat_waiting = Gauge("ragapp_chat_completions_waiting", "Chat completions waiting for a concurrency slot.")
+        chat_waiting.set(stats["waiting"])
+        chat_wait = Gauge("ragapp_chat_queue_wait_seconds", "Time chat completions waited for a concurrency slot.", ("stat",))
+        chat_wait.set(stats["mean_wait"], stat="mean")
+        chat_wait.set(stats["max_wait"], stat="max")
+        metrics += [chat_in_flight, chat_waiting, chat_wait]
+
+    if global_storage.searcher is not None:
+        stats = global_storage.searcher.pool_wait.stats()
+        pool_wait = Gauge("ragapp_db_pool_wait_seconds", "Time searches waited for a database connection.", ("stat",))
+        pool_wait.set(stats["mean"], stat="mean")
+        pool_wait.set(stats["max"], stat="max")
+        metrics.append(pool_wait)
+
+    stats = log_stats()
+    log_dropped = Counter("ragapp_log_records_dropped_total", "Log records dropped because a log queue was full.", ("sink",))
+    log_dropped.inc(stats["dropped"], sink="queue")
+    log_dropped.inc(stats["logtail_dropped"], sink="logtail")
+    metrics.append(log_dropped)
+
+    return metrics
+
+
+def render_metrics() -> str:
+    lines = []
+    for metric in METRICS + component_metrics():
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
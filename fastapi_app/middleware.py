@@ -1,42 +1,76 @@
-from fastapi import Request, Response
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.types import ASGIApp 
+import random
+import time
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
 from .logger import logger  # Import logger here to avoid circular import
-import json
-from starlette.responses import StreamingResponse
-from typing import Callable
 
-class LogMiddleware(BaseHTTPMiddleware):
-    def __init__(self, app: ASGIApp) -> None:
-        super().__init__(app)
 
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
+class LogMiddleware:
+    """
+    Pure ASGI middleware logging the method, path, status, request and response sizes and duration of each request.
+    Messages are passed through as they are received and sent, so bodies are never buffered and streamed answers are
+    not held back. With `log_bodies`, the first `max_body_bytes` of the request and response bodies of a `sample_rate`
+    share of the requests are logged as well.
+    """
+    def __init__(self, app: ASGIApp, log_bodies: bool = False, max_body_bytes: int = 2048, sample_rate: float = 1.0) -> None:
+        self.app = app
+        self.log_bodies = log_bodies
+        self.max_body_bytes = max_body_bytes
+        self.sample_rate = sample_rate
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        client = scope.get("client")
         log_dict = {
-            'url': request.url.path, 
-            'method': request.method,
-            'client': request.client.host
+            'url': scope["path"],
+            'method': scope["method"],
+            'client': client[0] if client else None,
         }
-        #logger.info("Request received", extra=log_dict)
-
-        if request.method in ("POST", "PUT", "PATCH"):
-            try:
-                body = await request.json()
-                logger.info(f"Request body: {json.dumps(body)}", extra=log_dict)
-            except Exception as e:
-                logger.error(f"Error logging request body: {e}", extra=log_dict)
-
-        response = await call_next(request)
-
-        log_dict['status_code'] = response.status_code
-        logger.info("Response sent", extra=log_dict)
-
-        if response.status_code == 200:
-            response_body = b""
-            async for chunk in response.body_iterator:
-                response_body += chunk
-            #logger.info(f"Response body: {response_body.decode()}", extra=log_dict)
-            response = StreamingResponse(iter([response_body]), status_code=response.status_code)
-            for header, value in response.headers.items():
-                response.headers[header] = value
-
-        return response
+        log_body = self.log_bodies and random.random() < self.sample_rate
+        request_body = bytearray()
+        response_body = bytearray()
+        request_bytes = 0
+        response_bytes = 0
+        status_code = 500 # Reported if the app fails before starting the response
+
+        async def receive_and_count() -> Message:
+            nonlocal request_bytes
+            message = await receive()
+            if message["type"] == "http.request":
+                chunk = message.get("body", b"")
+                request_bytes += len(chunk)
+                if log_body:
+                    request_body.extend(chunk[:self.max_body_bytes - len(request_body)])
+            return message
+
+        async def send_and_count(message: Message) -> None:
+            nonlocal response_bytes, status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body":
+                chunk = message.get("body", b"")
+                response_bytes += len(chunk)
+                if log_body:
+                    response_body.extend(chunk[:self.max_body_bytes - len(response_body)])
+            await send(message)
+
+        try:
+            await self.app(scope, receive_and_count, send_and_count)
+        finally:
+            log_dict['status_code'] = status_code
+            log_dict['request_bytes'] = request_bytes
+            log_dict['response_bytes'] = response_bytes
+            log_dict['duration'] = round(time.perf_counter() - start, 4)
+            if log_body:
+                logger.info(f"Request body: {self.preview(request_body, request_bytes)}", extra=log_dict)
+                logger.info(f"Response body: {self.preview(response_body, response_bytes)}", extra=log_dict)
+            logger.info("Response sent", extra=log_dict)
+
+    def preview(self, body: bytearray, total_bytes: int) -> str:
+        text = body.decode(errors="replace")
+        if total_bytes > len(body):
+            text += f"... ({total_bytes} bytes)"
+        return text
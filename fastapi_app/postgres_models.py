@@ -2,9 +2,13 @@ from __future__ import annotations
 
 from pgvector.sqlalchemy import Vector
 from datetime import datetime
-from sqlalchemy import Index 
+from sqlalchemy import Computed, Index 
+from sqlalchemy.dialects.postgresql import TSVECTOR
 from sqlalchemy.orm import DeclarativeBase, Mapped, MappedAsDataclass, mapped_column
 
+from chatlse.postgres_indexes import CONTENT_TSVECTOR, FULLTEXT_INDEX_NAME, HNSW_OPCLASS, hnsw_index_name
+from chatlse.tokens import format_chunk_for_rag
+
 
 
 # Define the models
@@ -21,9 +25,14 @@ class Doc(Base):
     title: Mapped[str] = mapped_column()
     content: Mapped[str] = mapped_column()
     date_scraped: Mapped[datetime] = mapped_column()
-    simple_embeddings: Mapped[Vector] = mapped_column(Vector(1024)) # GTE-large
-    title_embeddings: Mapped[Vector] = mapped_column(Vector(1024)) # GTE-large
-    context_embeddings: Mapped[Vector] = mapped_column(Vector(1024)) # GTE-large
+    # Embeddings are deferred as they are only needed for indexing, not for building prompts 
+    simple_embeddings: Mapped[Vector] = mapped_column(Vector(1024), deferred=True) # GTE-large
+    title_embeddings: Mapped[Vector] = mapped_column(Vector(1024), deferred=True) # GTE-large
+    context_embeddings: Mapped[Vector] = mapped_column(Vector(1024), deferred=True) # GTE-large
+    # Stored tsvector of `content` for the full-text leg of hybrid search 
+    content_tsv: Mapped[str] = mapped_column(TSVECTOR, Computed(CONTENT_TSVECTOR, persisted=True), deferred=True, init=False)
+    # Token count of `to_str_for_rag()`, filled at ingestion (NULL for rows ingested before the column existed) 
+    token_count: Mapped[int | None] = mapped_column(nullable=True, default=None)
 
     def to_dict(self, include_embedding: bool = False):
         # Manually construct the dictionary
@@ -44,33 +53,41 @@ class Doc(Base):
         return model_dict
 
     def to_str_for_rag(self):
-        return f"Title: {self.title} URL: {self.url} Content: {self.content} Type:{self.type}"
+        return format_chunk_for_rag(self.title, self.url, self.content, self.type)
 
     def to_str_for_embedding(self):
         return f"Title: {self.title} URL: {self.url} Content: {self.content} Type: {self.type}"
 
 
-# Define HNSW index to support vector similarity search through the vector_cosine_ops access method (cosine distance).
+# Define GIN index to support full-text search on the stored tsvector column 
+index_fulltext = Index(
+    FULLTEXT_INDEX_NAME,
+    Doc.content_tsv,
+    postgresql_using="gin",
+)
+
+# Define HNSW indexes to support vector similarity search through the vector_cosine_ops access method (cosine distance), 
+# matching the `<=>` operator used by PostgresSearcher. Use `scripts/manage_indexes.py hnsw` to rebuild them with other parameters. 
 index_simple = Index(
-    "hnsw_index_for_innerproduct_doc_embedding",
+    hnsw_index_name("simple_embeddings"),
     Doc.simple_embeddings,
     postgresql_using="hnsw",
     postgresql_with={"m": 16, "ef_construction": 64},
-    postgresql_ops={"simple_embeddings": "vector_ip_ops"},
+    postgresql_ops={"simple_embeddings": HNSW_OPCLASS},
 )
 
 index_title = Index(
-    "hnsw_index_for_innerproduct_doc_embedding",
+    hnsw_index_name("title_embeddings"),
     Doc.title_embeddings,
     postgresql_using="hnsw",
     postgresql_with={"m": 16, "ef_construction": 64},
-    postgresql_ops={"title_embeddings": "vector_ip_ops"},
+    postgresql_ops={"title_embeddings": HNSW_OPCLASS},
 )
 
 index_context = Index(
-    "hnsw_index_for_innerproduct_doc_embedding",
+    hnsw_index_name("context_embeddings"),
     Doc.context_embeddings,
     postgresql_using="hnsw",
     postgresql_with={"m": 16, "ef_construction": 64},
-    postgresql_ops={"context_embeddings": "vector_ip_ops"},
-)
\ No newline at end of file
+    postgresql_ops={"context_embeddings": HNSW_OPCLASS},
+)
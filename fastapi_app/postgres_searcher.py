@@ -1,27 +1,179 @@
+import asyncio
+import functools
+import logging
+import time
+from datetime import datetime
+
 from pgvector.utils import to_db
-from sqlalchemy import Float, Integer, String, select, text
+from sqlalchemy import DateTime, select, text
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from chatlse.postgres_indexes import EMBEDDING_COLUMNS
+
 from .postgres_models import Doc
 
+logger = logging.getLogger("ragapp")
+
+# Columns needed to build prompts and ThoughtSteps (everything but the embeddings)
+DOC_COLUMNS = [
+    Doc.id, Doc.doc_id, Doc.chunk_id, Doc.type, Doc.url, Doc.title, Doc.content, Doc.date_scraped, Doc.token_count
+]
+
+# Columns and operators that may be used in search filters
+FILTER_COLUMNS = {column.name: column for column in DOC_COLUMNS if column.name != "content"}
+FILTER_OPERATORS = {"=", "!=", "<>", "<", "<=", ">", ">=", "LIKE", "ILIKE"}
+
+# "sql": RRF in one query, "app": vector and full-text legs run concurrently and are fused in Python
+HYBRID_MODES = ["sql", "app"]
+
+# Results taken from each leg of a hybrid search unless `candidates` is given
+DEFAULT_CANDIDATES = 20
+
+# Postgres default of hnsw.ef_search. An HNSW scan returns at most ef_search rows, so it is raised for queries asking
+# for more candidates than that
+DEFAULT_EF_SEARCH = 40
+
+# Pool checkout waits longer than this (in seconds) are logged as warnings, the others only at debug level
+SLOW_POOL_WAIT = 0.1
+
+
+def compile_filters(filters: list[dict] | None) -> tuple[str, dict]:
+    """
+    Compiles `filters` ({"column", "comparison_operator", "value"} dicts) into a SQL condition with bound parameters,
+    so that the SQL text only depends on the filter columns and operators and never on the values.
+    """
+    if not filters:
+        return "", {}
+
+    filter_clauses = []
+    params = {}
+    for i, filter in enumerate(filters):
+        column = filter["column"]
+        operator = filter["comparison_operator"].strip().upper()
+        if column not in FILTER_COLUMNS:
+            raise ValueError(f"Cannot filter on column {column!r}, must be in {sorted(FILTER_COLUMNS)}")
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported comparison operator {operator!r}, must be in {sorted(FILTER_OPERATORS)}")
+
+        value = filter["value"]
+        if isinstance(FILTER_COLUMNS[column].type, DateTime) and isinstance(value, str):
+            value = datetime.fromisoformat(value)
+
+        param_name = f"filter_{i}"
+        filter_clauses.append(f"{column} {operator} :{param_name}")
+        params[param_name] = value
+
+    return " AND ".join(filter_clauses), params
+
+
+@functools.lru_cache(maxsize=128)
+def build_search_statement(mode: str, embedding_type: str, filter_clause: str):
+    """
+    Builds (and caches) the search statement for one query shape. As the SQL text is the same for every query of
+    that shape, asyncpg reuses its prepared statement instead of parsing and planning the query again.
+    """
+    filter_clause_where = f"WHERE {filter_clause}" if filter_clause else ""
+    filter_clause_and = f"AND {filter_clause}" if filter_clause else ""
+
+    vector_query = f"""
+        SELECT id, RANK () OVER (ORDER BY {embedding_type} <=> :{embedding_type}) AS rank
+            FROM lse_doc
+            {filter_clause_where}
+            ORDER BY {embedding_type} <=> :{embedding_type}
+            LIMIT :candidates
+        """
+
+    fulltext_query = f"""
+        SELECT id, RANK () OVER (ORDER BY ts_rank_cd(content_tsv, query) DESC) AS rank
+            FROM lse_doc, plainto_tsquery('english', :query) query
+            WHERE content_tsv @@ query {filter_clause_and}
+            ORDER BY ts_rank_cd(content_tsv, query) DESC
+            LIMIT :candidates
+        """
+
+    hybrid_query = f"""
+    WITH vector_search AS (
+        {vector_query}
+    ),
+    fulltext_search AS (
+        {fulltext_query}
+    )
+    SELECT
+        COALESCE(vector_search.id, fulltext_search.id) AS id,
+        :vector_weight * COALESCE(1.0 / (:k + vector_search.rank), 0.0) +
+        :text_weight * COALESCE(1.0 / (:k + fulltext_search.rank), 0.0) AS score
+    FROM vector_search
+    FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
+    ORDER BY score DESC
+    LIMIT :candidates
+    """
+
+    if mode == "hybrid":
+        ranking_query, order_by = hybrid_query, "ranked.score DESC"
+    elif mode == "vector":
+        ranking_query, order_by = vector_query, "ranked.rank"
+    else:
+        ranking_query, order_by = fulltext_query, "ranked.rank"
+
+    # Rank and fetch the documents in one round trip, without the (deferred) embedding columns
+    doc_query = f"""
+    WITH ranked AS (
+        {ranking_query}
+    )
+    SELECT {", ".join(f"lse_doc.{column.name}" for column in DOC_COLUMNS)}
+    FROM ranked
+    JOIN lse_doc ON lse_doc.id = ranked.id
+    ORDER BY {order_by}
+    LIMIT :query_top
+    """
+    return select(Doc).from_statement(text(doc_query).columns(*DOC_COLUMNS))
+
+
+def reciprocal_rank_fusion(rankings: list[tuple[list[Doc], float]], k: int = 60) -> list[Doc]:
+    """
+    Fuses ranked lists of documents, each with a weight, by weighted reciprocal rank: sum of weight / (k + rank).
+    """
+    scores = {}
+    docs_by_id = {}
+    for docs, weight in rankings:
+        for rank, doc in enumerate(docs, start=1):
+            scores[doc.id] = scores.get(doc.id, 0.0) + weight / (k + rank)
+            docs_by_id.setdefault(doc.id, doc)
+    return [docs_by_id[id] for id in sorted(scores, key=scores.get, reverse=True)]
+
+
+class PoolWaitStats:
+    """
+    Time spent waiting for a pooled connection, used to size POSTGRES_POOL_SIZE / POSTGRES_MAX_OVERFLOW.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, wait: float):
+        self.count += 1
+        self.total += wait
+        self.max = max(self.max, wait)
+
+    def stats(self) -> dict:
+        return {"count": self.count, "mean": self.total / self.count if self.count else 0.0, "max": self.max}
+
 
 class PostgresSearcher:
+    """
+    Created once per process in `lifespan` and shared by all requests.
+    """
 
-    def __init__(self, engine):
+    def __init__(self, engine, ef_search: int | None = None, hybrid_mode: str = "sql"):
+        if hybrid_mode not in HYBRID_MODES:
+            raise ValueError(f"hybrid_mode must be in {HYBRID_MODES}")
+        self.engine = engine
         self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
-
-    def build_filter_clause(self, filters) -> tuple[str, str]:
-        if filters is None:
-            return "", ""
-        filter_clauses = []
-        for filter in filters:
-            if isinstance(filter["value"], str):
-                filter["value"] = f"'{filter['value']}'"
-            filter_clauses.append(f"{filter['column']} {filter['comparison_operator']} {filter['value']}")
-        filter_clause = " AND ".join(filter_clauses)
-        if len(filter_clause) > 0:
-            return f"WHERE {filter_clause}", f"AND {filter_clause}"
-        return "", ""
+        self.ef_search = ef_search # Minimum hnsw.ef_search for vector queries, Postgres default (40) if None
+        self.hybrid_mode = hybrid_mode # Default way of fusing hybrid search results, see `search`
+        self.pool_wait = PoolWaitStats()
 
     async def search(
         self,
@@ -30,63 +182,71 @@ class PostgresSearcher:
         query_top: int = 5,
         filters: list[dict] | None = None,
         embedding_type: str = "title_embeddings",
+        hybrid_mode: str | None = None,
+        candidates: int = DEFAULT_CANDIDATES,
+        k: int = 60,
+        vector_weight: float = 1.0,
+        text_weight: float = 1.0,
     ):
-
-        filter_clause_where, filter_clause_and = self.build_filter_clause(filters)
-
-        vector_query = f"""
-            SELECT id, RANK () OVER (ORDER BY {embedding_type} <=> :{embedding_type}) AS rank
-                FROM lse_doc
-                {filter_clause_where}
-                ORDER BY {embedding_type} <=> :{embedding_type}
-                LIMIT 20
-            """
-
-        fulltext_query = f"""
-            SELECT id, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', content), query) DESC)
-                FROM lse_doc, plainto_tsquery('english', :query) query
-                WHERE to_tsvector('english', content) @@ query {filter_clause_and}
-                ORDER BY ts_rank_cd(to_tsvector('english', content), query) DESC
-                LIMIT 20
-            """
-
-        hybrid_query = f"""
-        WITH vector_search AS (
-            {vector_query}
-        ),
-        fulltext_search AS (
-            {fulltext_query}
-        )
-        SELECT
-            COALESCE(vector_search.id, fulltext_search.id) AS id,
-            COALESCE(1.0 / (:k + vector_search.rank), 0.0) +
-            COALESCE(1.0 / (:k + fulltext_search.rank), 0.0) AS score
-        FROM vector_search
-        FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
-        ORDER BY score DESC
-        LIMIT 20
         """
+        Returns the `query_top` most relevant documents. Hybrid search fuses the vector and full-text rankings with
+        reciprocal rank fusion (RRF), either in a single SQL query (`hybrid_mode="sql"`) or by running both legs
+        concurrently on separate connections and fusing them in Python (`hybrid_mode="app"`). `candidates` is the
+        number of results taken from each leg, `k` the RRF constant and `vector_weight` / `text_weight` the weights
+        of the two legs. `hybrid_mode` defaults to the one the searcher was created with.
+        """
+        if embedding_type not in EMBEDDING_COLUMNS:
+            raise ValueError(f"embedding_type must be in {EMBEDDING_COLUMNS}")
+
+        hybrid_mode = hybrid_mode or self.hybrid_mode
+        if hybrid_mode not in HYBRID_MODES:
+            raise ValueError(f"hybrid_mode must be in {HYBRID_MODES}")
+
+        filter_clause, params = compile_filters(filters)
 
         if query_text is not None and len(query_vector) > 0:
-            sql = text(hybrid_query).columns(id=String, score=Float)
+            mode = "hybrid"
         elif len(query_vector) > 0:
-            sql = text(vector_query).columns(id=String, rank=Integer)
+            mode = "vector"
         elif query_text is not None:
-            sql = text(fulltext_query).columns(id=String, rank=Integer)
+            mode = "fulltext"
         else:
             raise ValueError("Both query text and query vector are empty")
 
+        params.update({
+            embedding_type: to_db(query_vector),
+            "query": query_text,
+            "candidates": candidates,
+            "k": k,
+            "vector_weight": vector_weight,
+            "text_weight": text_weight,
+        })
+
+        if mode == "hybrid" and hybrid_mode == "app":
+            vector_docs, text_docs = await asyncio.gather(
+                self.execute(build_search_statement("vector", embedding_type, filter_clause), {**params, "query_top": candidates}, use_ef_search=True),
+                self.execute(build_search_statement("fulltext", embedding_type, filter_clause), {**params, "query_top": candidates}),
+            )
+            return reciprocal_rank_fusion([(vector_docs, vector_weight), (text_docs, text_weight)], k=k)[:query_top]
+
+        sql = build_search_statement(mode, embedding_type, filter_clause)
+        return await self.execute(sql, {**params, "query_top": query_top}, use_ef_search=len(query_vector) > 0)
+
+    async def execute(self, sql, params: dict, use_ef_search: bool = False):
         async with self.async_session_maker() as session:
-            results = (
-                await session.execute(
-                    sql,
-                    {embedding_type: to_db(query_vector), "query": query_text, "k": 60},
-                )
-            ).fetchall()
-
-            # Convert results to Doc models
-            docs = []
-            for id, _ in results[:query_top]:
-                doc = await session.execute(select(Doc).where(Doc.id == id))
-                docs.append(doc.scalar())
-            return docs
\ No newline at end of file
+            # Checking out the connection explicitly to measure how long requests queue for the pool
+            start = time.monotonic()
+            await session.connection()
+            wait = time.monotonic() - start
+            self.pool_wait.record(wait)
+            if wait > SLOW_POOL_WAIT:
+                logger.warning(f"Slow pool checkout: {wait:.4f}s ({self.engine.pool.status()})")
+            else:
+                logger.debug(f"Pool checkout wait: {wait:.4f}s")
+
+            ef_search = max(self.ef_search or DEFAULT_EF_SEARCH, params["candidates"], params["query_top"])
+            if use_ef_search and ef_search != DEFAULT_EF_SEARCH:
+                # Transaction-local, so it does not leak to other users of the pooled connection
+                await session.execute(text("SELECT set_config('hnsw.ef_search', :ef_search, true)"), {"ef_search": str(ef_search)})
+            docs = (await session.scalars(sql, params)).all()
+            return list(docs)
@@ -0,0 +1,58 @@
+import asyncio
+import cProfile
+import logging
+import os
+import time
+import uuid
+
+logger = logging.getLogger("ragapp")
+
+PROFILE_HEADER = "X-Profile"
+PROFILE_OVERRIDE = "profile"
+
+
+class RequestProfiler:
+    """
+    Runs cProfile around a single request when it asks for it with the `X-Profile` header or the `profile` override,
+    and writes the stats to `<profile_dir>/<profile_id>.prof` (see scripts/profile_summary.py). Requests that do not
+    ask for it only pay for the check. If `token` is set, the header or override value has to match it.
+
+    cProfile sees everything that runs on the event loop thread, so requests handled at the same time show up in
+    the profile too. Only one request is profiled at a time, the others run unprofiled.
+    """
+
+    def __init__(self, profile_dir: str, token: str | None = None):
+        self.profile_dir = profile_dir
+        self.token = token
+        self.active = False
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def is_requested(self, header: str | None, overrides: dict) -> bool:
+        value = header or overrides.get(PROFILE_OVERRIDE)
+        if not value or value in ("0", "false", "False"):
+            return False
+        if self.token is not None and value != self.token:
+            logger.warning("Profiling requested with an invalid token")
+            return False
+        return True
+
+    async def run(self, coro) -> tuple:
+        """
+        Awaits `coro` under cProfile. Returns its result and the profile id, None if another request is being profiled.
+        """
+        if self.active:
+            logger.warning("Profiling requested while another request is being profiled, skipping")
+            return await coro, None
+
+        profile_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        profiler = cProfile.Profile()
+        self.active = True
+        profiler.enable()
+        try:
+            return await coro, profile_id
+        finally:
+            profiler.disable()
+            self.active = False
+            path = os.path.join(self.profile_dir, f"{profile_id}.prof")
+            await asyncio.to_thread(profiler.dump_stats, path)
+            logger.info(f"Request profile written to {path}")
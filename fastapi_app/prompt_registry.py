@@ -0,0 +1,66 @@
+import logging
+import os
+import pathlib
+import time
+
+logger = logging.getLogger("ragapp")
+
+PROMPT_DIR = pathlib.Path(__file__).parent / "prompts"
+
+
+class PromptRegistry:
+    """
+    Process-wide store of the prompt templates in `fastapi_app/prompts/`. Templates are read once at startup and
+    re-read only when the file's mtime changes, so requests never open prompt files themselves.
+    """
+
+    def __init__(self, prompt_dir: str | os.PathLike = PROMPT_DIR, check_interval: float = 5.0):
+        self.prompt_dir = pathlib.Path(prompt_dir)
+        self.check_interval = check_interval # Minimum number of seconds between two mtime checks of the same file
+        self._prompts: dict[str, str] = {}
+        self._mtimes: dict[str, float] = {}
+        self._last_checked: dict[str, float] = {}
+
+    def _read(self, name: str) -> str:
+        path = self.prompt_dir / f"{name}.txt"
+        mtime = path.stat().st_mtime
+        with open(path) as f:
+            self._prompts[name] = f.read()
+        self._mtimes[name] = mtime
+        self._last_checked[name] = time.monotonic()
+        return self._prompts[name]
+
+    def load(self):
+        """
+        Reads every `*.txt` template in the prompt directory. Called once at lifespan startup.
+        """
+        for path in sorted(self.prompt_dir.glob("*.txt")):
+            self._read(path.stem)
+        logger.info(f"{len(self._prompts)} prompts are loaded from {self.prompt_dir}")
+
+    def get(self, name: str) -> str:
+        """
+        Returns the template `name` (file name without `.txt`), reloading it if the file changed on disk.
+        """
+        if name not in self._prompts:
+            return self._read(name)
+
+        now = time.monotonic()
+        if now - self._last_checked[name] >= self.check_interval:
+            self._last_checked[name] = now
+            try:
+                mtime = (self.prompt_dir / f"{name}.txt").stat().st_mtime
+            except FileNotFoundError:
+                # Keep serving the last known version if the file is being replaced
+                return self._prompts[name]
+            if mtime != self._mtimes[name]:
+                logger.info(f"Prompt {name} changed on disk, reloading")
+                return self._read(name)
+
+        return self._prompts[name]
+
+    def templates(self) -> dict[str, str]:
+        return dict(self._prompts)
+
+    def __getitem__(self, name: str) -> str:
+        return self.get(name)
@@ -1,5 +1,7 @@
+import asyncio
+import hashlib
 import json
-import pathlib
+import time
 from collections.abc import AsyncGenerator
 from typing import (
     Any,
@@ -7,17 +9,70 @@ from typing import (
 from .logger import logger
 
 from openai import AsyncOpenAI
+from openai.types import CompletionUsage
 from openai.types.chat import (
     ChatCompletion,
 )
-from openai_messages_token_helper import build_messages, get_token_limit
-
-from .globals import global_storage
+from openai_messages_token_helper import get_token_limit
 
+from .answer_cache import AnswerCache
 from .api_models import ThoughtStep
-from .postgres_searcher import PostgresSearcher
-from chatlse.embeddings import compute_text_embedding
-from chatlse.llm_functions import build_filter_function, build_filter_function_query_rewriter, extract_function_calls, extract_json, extract_json_query_rewriter, build_response_function
+from .conversation_store import ConversationState, new_conversation_id
+from .intent_classifier import TEMPLATED_RESPONSES, IntentClassifier
+from .latency_budget import LatencyBudget
+from .context_packer import pack_context
+from .token_counter import MESSAGE_OVERHEAD, TokenCounter
+from .prompt_registry import PromptRegistry
+from .postgres_searcher import DEFAULT_CANDIDATES, HYBRID_MODES, PostgresSearcher
+from chatlse.clients import BoundedChatClient
+from chatlse.embeddings import EMBED_MODEL, EmbeddingCache, compute_text_embedding
+from chatlse.reranker import Reranker
+from chatlse.llm_functions import build_filter_function, build_filter_function_query_rewriter, build_rewrite_and_classify_function, extract_function_calls, extract_json, extract_json_query_rewriter, extract_json_rewrite_and_classify, build_response_function
+
+# Request overrides forwarded to `PostgresSearcher.search` (override name: search argument) 
+SEARCH_OVERRIDES = {
+    "hybrid_mode": "hybrid_mode", 
+    "search_candidates": "candidates", 
+    "rrf_k": "k", 
+    "vector_weight": "vector_weight", 
+    "text_weight": "text_weight", 
+}
+
+# Type and allowed range of the numeric retrieval overrides (pgvector caps hnsw.ef_search, and so the candidates, at 
+# 1000, reranker scores are between 0 and 1, a latency budget of 0 would skip every stage) 
+SEARCH_OVERRIDE_RANGES = {
+    "search_candidates": (int, 1, 1000), 
+    "rrf_k": (int, 0, 1000), 
+    "vector_weight": (float, 0.0, 10.0), 
+    "text_weight": (float, 0.0, 10.0), 
+    "minimum_reranker_score": (float, 0.0, 1.0), 
+    "latency_budget": (float, 0.01, 300.0), 
+}
+
+
+def validate_search_overrides(overrides: dict[str, Any]) -> dict[str, Any]: 
+    """
+    Returns `overrides` with the search, reranker and latency budget overrides coerced to the types they are used 
+    with. Raises ValueError if one of them is not in its allowed set or range. 
+    """
+    validated = dict(overrides)
+    hybrid_mode = overrides.get("hybrid_mode")
+    if hybrid_mode is not None and hybrid_mode not in HYBRID_MODES: 
+        raise ValueError(f"hybrid_mode must be in {HYBRID_MODES}")
+    for override, (cast, minimum, maximum) in SEARCH_OVERRIDE_RANGES.items(): 
+        value = overrides.get(override)
+        if value is None: 
+            continue
+        try: 
+            # bool is a subclass of int, and int() would silently truncate a float 
+            if isinstance(value, bool) or (cast is int and isinstance(value, float) and not value.is_integer()): 
+                raise ValueError
+            validated[override] = cast(value)
+        except (TypeError, ValueError): 
+            raise ValueError(f"{override} must be a number of type {cast.__name__}, got {value!r}")
+        if not minimum <= validated[override] <= maximum: 
+            raise ValueError(f"{override} must be between {minimum} and {maximum}, got {value!r}")
+    return validated
 
 
 class AdvancedRAGChat: 
@@ -25,41 +80,208 @@ class AdvancedRAGChat:
         self,
         *,
         searcher: PostgresSearcher,
-        chat_client: AsyncOpenAI,
+        prompts: PromptRegistry,
+        state: ConversationState | None = None,
+        chat_client: BoundedChatClient | AsyncOpenAI,
         chat_model: str,
         embed_model: str,
         embed_dimensions: int,
         context_window_override: int | None, # Context window size (default to 4000 if None)
         to_summarise: bool | None, 
         embedding_type: str = "title_embeddings", 
-        with_user_context: bool = False
+        with_user_context: bool = False, 
+        concurrent_pipeline: bool = False, 
+        embedding_cache: EmbeddingCache | None = None, 
+        answer_cache: AnswerCache | None = None, 
+        reranker: Reranker | None = None, 
+        latency_budget: float | None = None, 
+        combined_rewrite_classify: float = 0.0, 
+        intent_classifier: IntentClassifier | None = None, 
+        token_counter: TokenCounter | None = None, 
+        context_token_budget: int | None = None
     ):
         self.searcher = searcher
+        self.state = state if state is not None else ConversationState(conversation_id=new_conversation_id())
         self.chat_client = chat_client
         self.chat_model = chat_model
         self.embed_model = embed_model
         self.embed_dimensions = embed_dimensions
+        self.embed_model_name = getattr(embed_model, "model_name", EMBED_MODEL)
+        self.embedding_cache = embedding_cache
+        self.answer_cache = answer_cache
+        self.reranker = reranker
+        self.use_reranker = False # Whether the current request reranks its results (`semantic_ranker` override) 
+        self.minimum_reranker_score = None # Reranked chunks scoring below it are dropped, no filtering if None 
+        self.answer_cache_context = None # Hash of user context and retrieval overrides of the current request 
+        self.answer_cache_query = None # (query, embedding) the answer of the current request would be cached under 
+        self.cached_response = None 
+        self.intent_classifier = intent_classifier
+        self.intent_response = None # Templated answer when the intent classifier is confident, no model call is made 
         self.chat_token_limit = context_window_override if context_window_override else get_token_limit(chat_model, default_to_minimum=True)
+        # Process-wide token count cache, used to fit prompts in `chat_token_limit` 
+        self.token_counter = token_counter if token_counter is not None else TokenCounter(chat_model)
+        # Maximum number of tokens of retrieved sources in the prompt, no limit other than the context window if None 
+        self.context_token_budget = context_token_budget
         self.to_summarise = to_summarise 
         self.embedding_type = embedding_type
         self.with_user_context = with_user_context
+        self.concurrent_pipeline = concurrent_pipeline
+        self.timings = {} # Per-stage latency (in seconds) of the current request 
+        self.token_usage = {} # Per-stage prompt and completion tokens reported by the model for the current request 
+        self.search_options = {} # Hybrid search settings of the current request, passed to `searcher.search` 
+        self.latency_budget = latency_budget # Seconds allowed before answer generation, no limit if None 
+        self.budget = LatencyBudget(None)
+        self.skipped_stages = [] # Stages skipped or degraded because the latency budget ran out 
+        self.rewrite_classify_override = None # `rewrite_classify_mode` override of the current request 
+        self.rewrite_classify_arm = None # A/B arm ("combined" or "separate") of the current request, None if not bucketed 
+        # Share of conversations (0 to 1) that rewrite and classify the query in a single model call, for A/B testing. 
+        # Only used by QueryRewriterRAG, accepted here so that both chat classes are built with the same arguments 
+        self.combined_rewrite_classify = combined_rewrite_classify
         
-        # Load prompts 
-        current_dir = pathlib.Path(__file__).parent
+        # Load prompts from the process-wide registry (read once at startup) 
+        self.prompts = prompts
         # Classify query 
-        self.query_prompt_template = open(current_dir / f"prompts/query.txt").read()
+        self.query_prompt_template = prompts.get("query")
         # Summariser prompt 
-        self.summarise_prompt_template = open(current_dir / f"prompts/summarize.txt").read()
+        self.summarise_prompt_template = prompts.get("summarize")
         # Decide whether a query is a response to clarification question 
-        self.clarification_response_prompt_template = open(current_dir / f"prompts/clarification_response.txt").read()
+        self.clarification_response_prompt_template = prompts.get("clarification_response")
         # Handling different types of queries 
-        self.greeting_prompt_template = open(current_dir / f"prompts/greeting.txt").read()
-        self.farewell_prompt_template = open(current_dir / f"prompts/farewell.txt").read()
-        self.require_clarification_prompt_template = open(current_dir / f"prompts/clarification.txt").read()
-        self.follow_up_prompt_template = open(current_dir / f"prompts/follow_up.txt").read()
-        self.clar_response_prompt_template = open(current_dir / f"prompts/clar_response.txt").read()
-        self.rag_answer_prompt_template = open(current_dir / f"prompts/rag_answer_advanced.txt").read()
-        self.no_answer_prompt_template = open(current_dir / f"prompts/no_answer_advanced.txt").read()
+        self.greeting_prompt_template = prompts.get("greeting")
+        self.farewell_prompt_template = prompts.get("farewell")
+        self.require_clarification_prompt_template = prompts.get("clarification")
+        self.follow_up_prompt_template = prompts.get("follow_up")
+        self.clar_response_prompt_template = prompts.get("clar_response")
+        self.rag_answer_prompt_template = prompts.get("rag_answer_advanced")
+        self.no_answer_prompt_template = prompts.get("no_answer_advanced")
+
+
+    async def timed(self, stage, coro): 
+        """
+        Awaits `coro` and records its wall-clock duration under `stage` in `self.timings`. 
+        """
+        start = time.monotonic()
+        try: 
+            return await coro 
+        finally: 
+            self.timings[stage] = round(time.monotonic() - start, 3)
+
+
+    def record_usage(self, stage, completion): 
+        """
+        Adds the prompt and completion tokens of `completion.usage` (if the model reported them) to `self.token_usage`. 
+        """
+        usage = getattr(completion, "usage", None)
+        if usage is None: 
+            return
+        # Stream chunks have no `usage` field in this openai version, it is kept as the raw dict 
+        if isinstance(usage, dict): 
+            usage = CompletionUsage(**usage)
+        stage_usage = self.token_usage.setdefault(stage, {"prompt_tokens": 0, "completion_tokens": 0})
+        stage_usage["prompt_tokens"] += usage.prompt_tokens or 0
+        stage_usage["completion_tokens"] += usage.completion_tokens or 0
+
+
+    async def within_budget(self, stage, coro, fallback): 
+        """
+        Like `timed`, but gives up on `coro` once `stage` has used its share of the latency budget. The stage is then 
+        recorded in `self.skipped_stages` and `fallback` is returned instead. 
+        """
+        timeout = self.budget.stage_timeout(stage)
+        if timeout is None: 
+            return await self.timed(stage, coro)
+
+        try: 
+            if timeout <= 0: 
+                coro.close()
+                raise asyncio.TimeoutError
+            return await self.timed(stage, asyncio.wait_for(coro, timeout))
+        except asyncio.TimeoutError: 
+            logger.warning(f"Latency budget exhausted, skipping {stage} (timeout {timeout:.3f}s)")
+            self.skipped_stages.append(stage)
+            return fallback
+
+
+    async def embed_query(self, query): 
+        """
+        Returns the embedding of `query`, looking it up in the embedding cache (if any) before calling the model. 
+        """
+        if self.embedding_cache is None: 
+            return await compute_text_embedding(query, None, self.embed_model)
+
+        vector = await self.embedding_cache.get(query, self.embed_model_name)
+        if vector is not None: 
+            logger.info(f"Embedding cache hit: {self.embedding_cache.stats()}")
+            return vector
+
+        vector = await compute_text_embedding(query, None, self.embed_model)
+        await self.embedding_cache.set(query, self.embed_model_name, vector)
+        return vector
+
+
+    async def lookup_answer_cache(self, search_query, vector_search): 
+        """
+        Looks up a previous answer to `search_query` in the answer cache. Sets and returns `self.cached_response`. 
+        """
+        if self.answer_cache is None: 
+            return None
+
+        query_vector = await self.embed_query(search_query) if vector_search else None
+        self.answer_cache_query = (search_query, query_vector)
+        self.cached_response = await self.timed("answer_cache", self.answer_cache.lookup(search_query, self.answer_cache_context, query_vector))
+        return self.cached_response
+
+
+    async def store_answer(self, chat_resp, results): 
+        """
+        Stores a RAG answer in the answer cache, answers that do not cite any source are never cached. 
+        """
+        if self.answer_cache is None or self.answer_cache_query is None or not results or self.cached_response is not None: 
+            return
+
+        search_query, query_vector = self.answer_cache_query
+        # Only the answer and its sources are shared, the prompt holds this user's conversation 
+        choice = chat_resp["choices"][0]
+        await self.answer_cache.store(
+            search_query, self.answer_cache_context, query_vector, choice["message"]["content"], choice["context"]["data_points"]["text"], results
+        )
+
+
+    async def serve_cached_response(self, vector_search, text_search, top): 
+        """
+        Builds the response to a cache hit from the cached answer and sources, the thoughts are those of this request. 
+        """
+        search_query, _ = self.answer_cache_query
+        chat_resp = {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": self.cached_response["answer"]}, "finish_reason": "stop"}], 
+            "conversation_id": self.state.conversation_id, 
+            "answer_cache": True, 
+            "skipped_stages": self.skipped_stages, 
+        }
+        await self.display_thoughtstep(chat_resp, [], vector_search, text_search, top, self.cached_response["sources"], search_query, [])
+        return chat_resp
+
+
+    def answer_from_intent(self, original_user_query): 
+        """
+        Runs the fast intent classifier on the user query. If it is confident, sets `self.intent_response` to the 
+        templated answer and returns True, otherwise the query goes through the model classification as usual. 
+        """
+        decision = self.intent_classifier.classify(original_user_query)
+        confident = self.intent_classifier.is_confident(decision)
+        logger.info(f"Intent classifier: {decision.intent} (confidence {decision.confidence:.2f}, {'answered from template' if confident else 'deferred to model'})")
+        if not confident: 
+            return False
+
+        self.intent_response = {
+            "choices": [{
+                "index": 0, 
+                "message": {"role": "assistant", "content": TEMPLATED_RESPONSES[decision.intent]}, 
+                "finish_reason": "stop", 
+            }], 
+            "intent": {"intent": decision.intent, "confidence": decision.confidence}, 
+        }
+        return True
 
 
     async def summarise_resp(self, past_messages): 
@@ -69,7 +291,7 @@ class AdvancedRAGChat:
         """
         to_summarise = past_messages[-5]["content"] 
         response_token_limit = 1024
-        messages = build_messages(
+        messages = self.token_counter.build_messages(
             model=self.chat_model,
             system_prompt=self.summarise_prompt_template,
             new_user_content=to_summarise,
@@ -86,6 +308,7 @@ class AdvancedRAGChat:
             stream=False,
         )
 
+        self.record_usage("summarise", chat_completion_response)
         past_messages[-5]["content"] = chat_completion_response.choices[0].message.content
 
 
@@ -93,10 +316,10 @@ class AdvancedRAGChat:
         """
         After clarifying user query, judges whether the user's answer is a direct response to the model's clarification question. 
         """
-        messages = build_messages(
+        messages = self.token_counter.build_messages(
             model=self.chat_model,
             system_prompt=self.clarification_response_prompt_template,
-            new_user_content=original_user_query + "\n\nUser Context:\n" + global_storage.user_context,
+            new_user_content=original_user_query + "\n\nUser Context:\n" + self.state.user_context,
             past_messages=[past_messages[-1]],
             max_tokens=self.chat_token_limit - response_token_limit,
             fallback_to_default=True
@@ -115,6 +338,7 @@ class AdvancedRAGChat:
             stream=False,
         )
 
+        self.record_usage("clarification", chat_completion_clar_response)
         clarification_response = extract_function_calls(chat_completion_clar_response, "is_response")
 
         return clarification_response
@@ -126,7 +350,7 @@ class AdvancedRAGChat:
         to decide which categories the user query fits in, and returns how the model would handle the query.  
         """
         # Generate prompt that asks the model to first classify the query before answering 
-        query_messages = build_messages(
+        query_messages = self.token_counter.build_messages(
             model=self.chat_model,
             system_prompt=self.query_prompt_template,
             new_user_content=original_user_query,
@@ -147,6 +371,8 @@ class AdvancedRAGChat:
         )
 
         
+        self.record_usage("classify", chat_completion_resp_filter)
+
         # Extract model decision on query classification 
     
         to_greet, is_follow_up, is_reference, is_relevant, requires_clarification, is_farewell = extract_json(chat_completion_resp_filter)
@@ -157,15 +383,15 @@ class AdvancedRAGChat:
         
         logger.info(f"to_search: {to_search}")
         logger.info(f"to_follow_up: {to_follow_up}")
-        logger.info(f"global_storage.requires_calrification: {global_storage.requires_clarification}")
+        logger.info(f"state.requires_clarification: {self.state.requires_clarification}")
 
 
         # Inserting different system prompts for model based on specific functionalities required 
-        if global_storage.requires_clarification:
+        if self.state.requires_clarification:
             logger.info("ENTERED GLOBAL STORAGE CLARIFICATION")
             clarification_response = await self.judge_clarification_response(original_user_query, past_messages, query_response_token_limit)
-            #reset global storage until next requires_clarification occurs.
-            global_storage.requires_clarification = False
+            #reset conversation state until next requires_clarification occurs.
+            self.state.requires_clarification = False
         
         else:
             clarification_response = False
@@ -173,6 +399,65 @@ class AdvancedRAGChat:
         return to_greet, is_farewell, requires_clarification, to_follow_up, to_search, clarification_response
 
 
+    async def search_and_rerank(self, query_text, vector, rerank_query, top): 
+        """
+        Runs the search with the search overrides of the request and, if enabled, reranks the results against 
+        `rerank_query`. Returns the query text actually used (None if the text leg was dropped) and the `top` results. 
+        """
+        # Retrieve more candidates than needed and let the reranker pick the best `top` 
+        search_top = max(self.reranker.candidates, top) if self.use_reranker else top
+        # Each leg has to return at least as many rows as are asked for, or the reranker gets fewer candidates 
+        search_options = {**self.search_options, "candidates": max(self.search_options.get("candidates", DEFAULT_CANDIDATES), search_top)}
+        if query_text is not None and vector: 
+            # Hybrid search falls back to vector search alone when it runs out of budget 
+            results = await self.within_budget(
+                "search", 
+                self.searcher.search(query_text, vector, search_top, embedding_type=self.embedding_type, **search_options), 
+                None, 
+            )
+            if results is None: 
+                query_text = None
+                # Bounded by what is left of the budget, retrieval is skipped if that runs out too 
+                results = await self.within_budget(
+                    "vector_search", 
+                    self.searcher.search(None, vector, search_top, embedding_type=self.embedding_type, **search_options), 
+                    [], 
+                )
+        else: 
+            results = await self.within_budget(
+                "search", 
+                self.searcher.search(query_text, vector, search_top, embedding_type=self.embedding_type, **search_options), 
+                [], 
+            )
+
+        if self.use_reranker and results: 
+            reranked = await self.within_budget("rerank", self.reranker.rerank(rerank_query, results, self.minimum_reranker_score), None)
+            if reranked is None: 
+                # Keeps the search order 
+                results = results[:top]
+            elif not reranked: 
+                # A threshold never leaves the answer without sources 
+                logger.warning(f"No chunk scored above {self.minimum_reranker_score}, keeping the search order")
+                results = results[:top]
+            else: 
+                logger.info(f"Reranked {len(results)} chunks, {len(reranked)} kept (minimum score {self.minimum_reranker_score}): {[round(score, 3) for _, score in reranked[:top]]}")
+                results = [doc for doc, _ in reranked[:top]]
+
+        return query_text, results
+
+
+    def pack_sources(self, results, system_prompt, user_prefix, max_tokens): 
+        """
+        Sources get what the system prompt and user query leave of `max_tokens` (or less, if a budget is set), chunks 
+        of the same document are merged under one header. Returns the sources, the chunks kept and their token count. 
+        """
+        sources_budget = max_tokens - self.token_counter.count_message({"role": "system", "content": system_prompt}) - self.token_counter.count_text(user_prefix) - MESSAGE_OVERHEAD
+        if self.context_token_budget: 
+            sources_budget = min(sources_budget, self.context_token_budget)
+        documents, results, sources_tokens = pack_context(results, self.token_counter, sources_budget)
+        return [document.to_str_for_rag() for document in documents], results, sources_tokens
+
+
     async def build_final_query(
         self, 
         original_user_query, 
@@ -192,16 +477,16 @@ class AdvancedRAGChat:
         sources_content, query_text, results = None, None, None 
 
         if to_greet:
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.greeting_prompt_template,
-                new_user_content=original_user_query + "\n\nUser Context:\n" + global_storage.user_context,
+                new_user_content=original_user_query + "\n\nUser Context:\n" + self.state.user_context,
                 max_tokens=self.chat_token_limit - response_token_limit,
                 fallback_to_default=True,
             )
 
         elif is_farewell:
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model = self.chat_model,
                 system_prompt = self.farewell_prompt_template,
                 new_user_content = original_user_query,
@@ -210,86 +495,66 @@ class AdvancedRAGChat:
             )
 
         elif to_follow_up: 
-            content = global_storage.rag_results[-1]
+            content = self.state.rag_results[-1]
 
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.follow_up_prompt_template,
-                new_user_content=original_user_query + "\n\nUser Context:\n" + global_storage.user_context + "\n\nSources:\n" + content,
+                new_user_content=original_user_query + "\n\nUser Context:\n" + self.state.user_context + "\n\nSources:\n" + content,
                 past_messages=[past_messages[-1]], 
                 max_tokens=self.chat_token_limit - response_token_limit,
                 fallback_to_default=True,
             )
 
         elif requires_clarification:
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model = self.chat_model,
                 system_prompt = self.require_clarification_prompt_template,
-                new_user_content = original_user_query + "\n\nUser Context:\n" + global_storage.user_context,
+                new_user_content = original_user_query + "\n\nUser Context:\n" + self.state.user_context,
                 past_messages= past_messages,
                 max_tokens=self.chat_token_limit - response_token_limit,
                 fallback_to_default=True,
             )
-            global_storage.requires_clarification = True
+            self.state.requires_clarification = True
 
         elif to_search or clarification_response: 
             # Retrieve relevant documents from the database with the GPT optimized query
             vector: list[float] = []
-            #query_text = None 
+            # TODO: Create a optimised search query instead of just using the previous user query 
+            search_query = past_messages[-2]["content"] if clarification_response else original_user_query
             if vector_search:
-                if clarification_response:
-                    # TODO: Create a optimised search query instead of just using the previous user query 
-                    logger.info(f"Entering clarification response vector search with query text: {past_messages[-2]['content']}")
-                    vector = await compute_text_embedding(
-                        past_messages[-2]["content"],
-                        None,
-                        self.embed_model
-                    )
-                elif to_search:
-                    logger.info(f"Entering vector search with query text: {original_user_query}")
-                    vector = await compute_text_embedding(
-                        original_user_query,
-                        None,
-                        self.embed_model 
-                    )
-
-            if not text_search:
-                query_text = None
+                logger.info(f"Entering vector search with query text: {search_query}")
+                vector = await self.embed_query(search_query)
 
-            results = await self.searcher.search(query_text, vector, top, embedding_type=self.embedding_type)
+            query_text = search_query if text_search else None
+            query_text, results = await self.search_and_rerank(query_text, vector, search_query, top)
 
-            sources_content = [f"[{(doc.doc_id)}]: {doc.to_str_for_rag()}\n\n" for doc in results]
+            system_prompt = self.clar_response_prompt_template if clarification_response else self.rag_answer_prompt_template
+            user_prefix = original_user_query + "\n\nUser Context:\n" + self.state.user_context + "\n\nSources:\n"
+            max_tokens = self.chat_token_limit - response_token_limit
+            sources_content, results, sources_tokens = self.pack_sources(results, system_prompt, user_prefix, max_tokens)
             content = "\n".join(sources_content)
-            global_storage.rag_results.append(content)
- 
-            if clarification_response:
-                messages = build_messages(
-                    model = self.chat_model,
-                    system_prompt = self.clar_response_prompt_template,
-                    new_user_content = original_user_query + "\n\nUser Context:\n" + global_storage.user_context + "\n\nSources:\n" + content, 
-                    past_messages= past_messages,
-                    max_tokens=self.chat_token_limit - response_token_limit,
-                    fallback_to_default=True,
-                )
+            self.state.add_rag_result(content)
 
-            else:
-                messages = build_messages(
-                    model=self.chat_model,
-                    system_prompt=self.rag_answer_prompt_template,
-                    new_user_content=original_user_query + "\n\nUser Context:\n" + global_storage.user_context + "\n\nSources:\n" + content,
-                    past_messages=past_messages,
-                    max_tokens=self.chat_token_limit - response_token_limit,
-                    fallback_to_default=True,
-                )
+            messages = self.token_counter.build_messages(
+                model=self.chat_model,
+                system_prompt=system_prompt,
+                new_user_content=user_prefix + content,
+                past_messages=past_messages,
+                max_tokens=max_tokens,
+                fallback_to_default=True,
+                # Sum of cached counts, so the sources block is not tokenised again 
+                new_user_tokens=self.token_counter.count_text(user_prefix) + sources_tokens, 
+            )
 
 
         # If the model decides the query is out of scope 
         else: 
             no_answer = True
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.no_answer_prompt_template,
-                new_user_content=original_user_query + "\n\nUser Context:\n" + global_storage.user_context,
+                new_user_content=original_user_query + "\n\nUser Context:\n" + self.state.user_context,
                 max_tokens=self.chat_token_limit - response_token_limit,
                 fallback_to_default=True,
            )
@@ -316,7 +581,11 @@ class AdvancedRAGChat:
                         title="Whether RAG functionalities are used",
                         description=False,
                         props={
-                            "RAG":False
+                            "RAG":False, 
+                            "timings": self.timings, 
+                            "token_usage": self.token_usage, 
+                            "skipped_stages": self.skipped_stages, 
+                            "rewrite_classify_mode": self.rewrite_classify_arm, 
                         }
                     ),
                     ThoughtStep(
@@ -344,7 +613,11 @@ class AdvancedRAGChat:
                         title="Whether RAG functionalities are used",
                         description=True,
                         props={
-                            "RAG": True
+                            "RAG": True, 
+                            "timings": self.timings, 
+                            "token_usage": self.token_usage, 
+                            "skipped_stages": self.skipped_stages, 
+                            "rewrite_classify_mode": self.rewrite_classify_arm, 
                         }
                     ),
                     ThoughtStep(
@@ -395,44 +668,79 @@ class AdvancedRAGChat:
         return messages, sources_content, query_text, results 
 
 
-    async def run(
+    async def prepare_context(
         self, messages: list[dict], user_info: dict[str, Any] = {}, overrides: dict[str, Any] = {}, 
-    ) -> dict[str, Any] | AsyncGenerator[dict[str, Any], None]:
+    ):
+        """
+        Runs every stage before answer generation (summarisation, classification, retrieval) and returns the messages 
+        for the final model call together with the retrieval details needed to build the ThoughtStep context. 
+        """
+        self.budget = LatencyBudget(overrides.get("latency_budget") or self.latency_budget)
+        self.skipped_stages = []
+        self.rewrite_classify_override = overrides.get("rewrite_classify_mode")
+        self.rewrite_classify_arm = None
 
         # Generate JSON formatted string for user context information
-        global_storage.user_context = str(user_info) 
-        logger.info(f"USER CONTEXT: {global_storage.user_context}")
+        self.state.user_context = str(user_info) 
+        logger.info(f"USER CONTEXT: {self.state.user_context}")
         
         # Get overrides 
         text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
         vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
         top = overrides.get("top", 3)
+        self.search_options = {
+            option: overrides[override] for override, option in SEARCH_OVERRIDES.items() if overrides.get(override) is not None
+        }
+
+        self.use_reranker = self.reranker is not None and overrides.get("semantic_ranker", True) is not False
+        self.minimum_reranker_score = overrides.get("minimum_reranker_score")
+
+        if self.answer_cache is not None: 
+            self.answer_cache_context = AnswerCache.context_key(self.state.user_context, overrides)
 
         original_user_query = messages[-1]["content"]
         past_messages = messages[:-1]
 
-        # Clear cached RAG results if it builds up 
-        if len(global_storage.rag_results) >= 3: 
-            global_storage.rag_results = [global_storage.rag_results[-1]]
+        # Answer obvious greetings, farewells and out-of-scope queries without calling the model 
+        if self.intent_classifier is not None and self.answer_from_intent(original_user_query): 
+            return None, None, None, None, vector_search, text_search, top
 
         ############################################################################################################################################################
         
         # Summarise model output after 3 rounds of conversation 
         if self.to_summarise and len(past_messages) >= 6: 
-            await self.summarise_resp(past_messages) 
+            await self.within_budget("summarise", self.summarise_resp(past_messages), None) 
 
         ############################################################################################################################################################
         
         # Classify and build corresponding query messages for the model 
 
         messages, sources_content, query_text, results = await self.classify_and_build_message_wrapper(original_user_query, past_messages, vector_search, text_search, top)
+
+        return messages, sources_content, query_text, results, vector_search, text_search, top
+
+
+    async def run(
+        self, messages: list[dict], user_info: dict[str, Any] = {}, overrides: dict[str, Any] = {}, 
+    ) -> dict[str, Any]:
+
+        messages, sources_content, query_text, results, vector_search, text_search, top = await self.prepare_context(messages, user_info, overrides)
+
+        if self.cached_response is not None: 
+            return await self.serve_cached_response(vector_search, text_search, top)
+
+        if self.intent_response is not None: 
+            chat_resp = self.intent_response
+            chat_resp["conversation_id"] = self.state.conversation_id
+            await self.display_thoughtstep(chat_resp, [], vector_search, text_search, top, None, None, None)
+            return chat_resp
         
         ############################################################################################################################################################
 
         # Generate answer to user query 
         response_token_limit  = 1024
         
-        chat_completion_response = await self.chat_client.chat.completions.create(
+        chat_completion_response = await self.timed("generate", self.chat_client.chat.completions.create(
                 # Azure OpenAI takes the deployment name as the model name
                 model=self.chat_model,
                 messages=messages,
@@ -440,9 +748,12 @@ class AdvancedRAGChat:
                 max_tokens=response_token_limit,
                 n=1,
                 stream=False,
-            )
+            ))
         
+        self.record_usage("generate", chat_completion_response)
         chat_resp = chat_completion_response.model_dump()
+        chat_resp["conversation_id"] = self.state.conversation_id
+        chat_resp["skipped_stages"] = self.skipped_stages
 
         # Include ThoughtStep data for display in frontend 
         await self.display_thoughtstep(
@@ -456,25 +767,120 @@ class AdvancedRAGChat:
             results
         )
 
+        await self.store_answer(chat_resp, results)
+
         return chat_resp
 
 
+    async def run_stream(
+        self, messages: list[dict], user_info: dict[str, Any] = {}, overrides: dict[str, Any] = {}, 
+    ) -> AsyncGenerator[dict[str, Any], None]:
+        """
+        Streaming variant of `run`. Yields the ThoughtStep context as soon as retrieval is done, followed by the answer 
+        token deltas in the same chunk format as the OpenAI streaming API. 
+        """
+        start_time = time.monotonic()
+
+        messages, sources_content, query_text, results, vector_search, text_search, top = await self.prepare_context(messages, user_info, overrides)
+
+        if self.cached_response is not None: 
+            cached_resp = await self.serve_cached_response(vector_search, text_search, top)
+            choice = cached_resp["choices"][0]
+            yield {"choices": [{"index": 0, "delta": {"role": "assistant"}, "context": choice.get("context"), "finish_reason": None}], "conversation_id": cached_resp["conversation_id"], "answer_cache": True, "skipped_stages": self.skipped_stages}
+            yield {"choices": [{"index": 0, "delta": {"role": "assistant", "content": choice["message"]["content"]}, "finish_reason": "stop"}]}
+            return
+
+        if self.intent_response is not None: 
+            chat_resp = {"choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}], "conversation_id": self.state.conversation_id, "intent": self.intent_response["intent"]}
+            await self.display_thoughtstep(chat_resp, [], vector_search, text_search, top, None, None, None)
+            yield chat_resp
+            yield {"choices": [{"index": 0, "delta": {"role": "assistant", "content": self.intent_response["choices"][0]["message"]["content"]}, "finish_reason": "stop"}]}
+            return
+
+        # Send retrieval context first so the frontend can render sources while the answer is being generated 
+        chat_resp = {"choices": [{"index": 0, "delta": {"role": "assistant"}, "finish_reason": None}], "conversation_id": self.state.conversation_id, "skipped_stages": self.skipped_stages}
+        await self.display_thoughtstep(
+            chat_resp, 
+            messages, 
+            vector_search, 
+            text_search, 
+            top, 
+            sources_content, 
+            query_text, 
+            results
+        )
+        yield chat_resp
+
+        ############################################################################################################################################################
+
+        # Generate answer to user query 
+        response_token_limit  = 1024
+
+        generate_start = time.monotonic()
+        chat_completion_async_stream = await self.chat_client.chat.completions.create(
+                model=self.chat_model,
+                messages=messages,
+                temperature=0, # Setting temperature to 0 for testing
+                max_tokens=response_token_limit,
+                n=1,
+                stream=True,
+                # Asks for a last chunk with the token usage (`stream_options` is not a parameter of this openai version) 
+                extra_body={"stream_options": {"include_usage": True}}, 
+            )
+
+        first_token = True 
+        answer = ""
+        async for response_chunk in chat_completion_async_stream:
+            # Ollama may send chunks without choices (e.g. usage), these are not forwarded 
+            if not response_chunk.choices:
+                self.record_usage("generate", response_chunk)
+                continue
+            if response_chunk.choices[0].delta.content:
+                if first_token:
+                    self.timings["time_to_first_token"] = round(time.monotonic() - start_time, 3)
+                    logger.info(f"Time to first token: {time.monotonic() - start_time:.3f}s")
+                    first_token = False
+                answer += response_chunk.choices[0].delta.content
+            yield response_chunk.model_dump()
+
+        self.timings["generate"] = round(time.monotonic() - generate_start, 3)
+        logger.info(f"Total streaming time: {time.monotonic() - start_time:.3f}s")
+
+        # Cache the streamed answer in the same shape as a non-streaming response 
+        chat_resp["choices"][0]["message"] = {"role": "assistant", "content": answer}
+        del chat_resp["choices"][0]["delta"]
+        await self.store_answer(chat_resp, results)
+
+
 class QueryRewriterRAG(AdvancedRAGChat): 
     def __init__(
         self,
         *,
         searcher: PostgresSearcher,
-        chat_client: AsyncOpenAI,
+        prompts: PromptRegistry,
+        state: ConversationState | None = None,
+        chat_client: BoundedChatClient | AsyncOpenAI,
         chat_model: str,
         embed_model: str,
         embed_dimensions: int,
         context_window_override: int | None, # Context window size (default to 4000 if None)
         to_summarise: bool | None, 
         embedding_type: str = "title_embeddings", 
-        with_user_context: bool = False
+        with_user_context: bool = False, 
+        concurrent_pipeline: bool = False, 
+        embedding_cache: EmbeddingCache | None = None, 
+        answer_cache: AnswerCache | None = None, 
+        reranker: Reranker | None = None, 
+        latency_budget: float | None = None, 
+        combined_rewrite_classify: float = 0.0, 
+        intent_classifier: IntentClassifier | None = None, 
+        token_counter: TokenCounter | None = None, 
+        context_token_budget: int | None = None
     ): 
         super().__init__(
             searcher=searcher,
+            prompts=prompts,
+            state=state,
             chat_client=chat_client, 
             chat_model=chat_model, 
             embed_model=embed_model, 
@@ -482,21 +888,32 @@ class QueryRewriterRAG(AdvancedRAGChat):
             context_window_override=context_window_override, 
             to_summarise=to_summarise, 
             embedding_type=embedding_type, 
-            with_user_context = with_user_context
+            with_user_context = with_user_context, 
+            concurrent_pipeline = concurrent_pipeline, 
+            embedding_cache = embedding_cache, 
+            answer_cache = answer_cache, 
+            reranker = reranker, 
+            latency_budget = latency_budget, 
+            combined_rewrite_classify = combined_rewrite_classify, 
+            intent_classifier = intent_classifier, 
+            token_counter = token_counter, 
+            context_token_budget = context_token_budget
             ) 
 
-        # Load prompts 
-        current_dir = pathlib.Path(__file__).parent
-        # Classify query 
-        self.query_prompt_template = open(current_dir / f"prompts/query.txt").read()
-        # Summariser prompt 
-        self.summarise_prompt_template = open(current_dir / f"prompts/summarize.txt").read()
-        # Handling different types of queries 
-        self.greeting_prompt_template = open(current_dir / f"prompts/greeting.txt").read()
-        self.farewell_prompt_template = open(current_dir / f"prompts/farewell.txt").read()
-        self.query_rewriter_prompt_template = open(current_dir / f"prompts/query_rewriter.txt").read()
-        self.rag_answer_prompt_template = open(current_dir / f"prompts/rag_answer_advanced.txt").read()
-        self.no_answer_prompt_template = open(current_dir / f"prompts/no_answer_advanced.txt").read()
+        # Load query rewriter prompt (remaining prompts are loaded by AdvancedRAGChat) 
+        self.query_rewriter_prompt_template = prompts.get("query_rewriter")
+        self.query_rewriter_classifier_prompt_template = prompts.get("query_rewriter_classifier")
+
+
+    def rewrite_classify_mode(self): 
+        """
+        Returns "combined" (one model call to rewrite and classify the query) or "separate" (one call each). Unless set 
+        by the `rewrite_classify_mode` override, conversations are bucketed by id so that each one stays in one arm. 
+        """
+        if self.rewrite_classify_override in ("combined", "separate"): 
+            return self.rewrite_classify_override
+        bucket = int(hashlib.sha1(self.state.conversation_id.encode("utf-8")).hexdigest()[:8], 16) / 0xFFFFFFFF
+        return "combined" if bucket < self.combined_rewrite_classify else "separate"
 
 
     async def classify_query(self, original_user_query, past_messages, query_response_token_limit=500):
@@ -505,7 +922,7 @@ class QueryRewriterRAG(AdvancedRAGChat):
         to decide which categories the user query fits in, and returns how the model would handle the query.  
         """
         # Generate prompt that asks the model to first classify the query before answering 
-        query_messages = build_messages(
+        query_messages = self.token_counter.build_messages(
             model=self.chat_model,
             system_prompt=self.query_prompt_template,
             new_user_content=original_user_query,
@@ -526,6 +943,8 @@ class QueryRewriterRAG(AdvancedRAGChat):
         )
 
         
+        self.record_usage("classify", chat_completion_resp_filter)
+
         # Extract model decision on query classification 
     
         to_greet, is_relevant, is_farewell = extract_json_query_rewriter(chat_completion_resp_filter)
@@ -542,7 +961,7 @@ class QueryRewriterRAG(AdvancedRAGChat):
             return original_user_query
         
         if len(past_messages) <= past_n: 
-            query_messages = build_messages(
+            query_messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.query_rewriter_prompt_template,
                 new_user_content=original_user_query,
@@ -551,7 +970,7 @@ class QueryRewriterRAG(AdvancedRAGChat):
                 fallback_to_default=True,
             )
         else: 
-            query_messages = build_messages(
+            query_messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.query_rewriter_prompt_template,
                 new_user_content=original_user_query,
@@ -569,62 +988,115 @@ class QueryRewriterRAG(AdvancedRAGChat):
             response_format={"type": "json_object"}, 
         )
 
+        self.record_usage("rewrite", chat_completion_resp_query_rewriter)
         rewritten_search_query = json.loads(chat_completion_resp_query_rewriter.choices[0].message.content)
 
         return rewritten_search_query["rewritten query"]
 
 
-    async def build_final_query(self, original_user_query, past_messages, search_query, to_greet, is_farewell, is_relevant, no_answer, vector_search, text_search, top, response_token_limit=1024):
-        sources_content, query_text, results = None, None, None 
-        
-        if is_relevant: 
-            # Retrieve relevant documents from the database with the GPT optimized query
-            vector: list[float] = []
-            query_text = None 
-            if vector_search:
+    async def rewrite_and_classify(self, original_user_query, past_messages, past_n=1, query_response_token_limit=500): 
+        """
+        Rewrites the search query and classifies it in a single model call. Returns the rewritten query (the original 
+        query if the model did not return one) and the greeting, relevant and farewell flags. 
+        """
+        query_messages = self.token_counter.build_messages(
+            model=self.chat_model,
+            system_prompt=self.query_rewriter_classifier_prompt_template,
+            new_user_content=original_user_query,
+            past_messages=past_messages[-past_n:] if past_messages else [], 
+            max_tokens=self.chat_token_limit - query_response_token_limit,  
+            fallback_to_default=True,
+        )
 
-                if self.with_user_context: 
-                    user_context = global_storage.user_context.replace("Master's", "Masters")
-                    user_context = json.loads(user_context.replace("'", '"'))
-                    role = user_context["role"]
-                    affiliation = user_context["department"]
-                    level = user_context["level_of_study"]
-                    context_sentence = "I am "
-                    if level or role: 
-                        context_sentence += f"a(n) {level.rstrip().lower()} {role.rstrip().lower()} "
-                    if affiliation: 
-                        context_sentence += f"from {affiliation.rstrip()}. "
-
-                    if role or affiliation or level: 
-                        search_query = context_sentence+search_query
-                
-                logger.info(f"Entering vector search with query text: {search_query}")
-                vector = await compute_text_embedding(
-                    search_query,
-                    None,
-                    self.embed_model 
-                )
+        chat_completion_resp: ChatCompletion = await self.chat_client.chat.completions.create(
+            messages=query_messages,  # type: ignore
+            model=self.chat_model,
+            temperature=0,  # Minimize creativity for search query generation
+            max_tokens=query_response_token_limit,  
+            n=1,
+            tools=build_rewrite_and_classify_function(),
+            tool_choice="required", 
+            response_format={"type": "json_object"}, 
+        )
 
-            if not text_search:
-                query_text = None
+        self.record_usage("rewrite_classify", chat_completion_resp)
+        rewritten_query, to_greet, is_relevant, is_farewell = extract_json_rewrite_and_classify(chat_completion_resp)
+        logger.info(f"to_greet: {to_greet}, is_relevant: {is_relevant}, is_farewell: {is_farewell}")
+
+        return rewritten_query or original_user_query, to_greet, is_relevant, is_farewell
+
+
+    async def retrieve(self, search_query, vector_search, text_search, top): 
+        """
+        Embeds the (rewritten) search query and retrieves the most relevant documents from the database. 
+        """
+        # Retrieve relevant documents from the database with the GPT optimized query
+        # Full-text search is the extra leg of hybrid search, dropped first when running out of time 
+        if vector_search and text_search and self.budget.is_short_for("retrieve"): 
+            logger.warning("Latency budget short, using vector search only")
+            self.skipped_stages.append("text_search")
+            text_search = False
+
+        vector: list[float] = []
+        query_text = search_query 
+        rerank_query = search_query 
+        if vector_search:
+
+            if self.with_user_context: 
+                user_context = self.state.user_context.replace("Master's", "Masters")
+                user_context = json.loads(user_context.replace("'", '"'))
+                role = user_context["role"]
+                affiliation = user_context["department"]
+                level = user_context["level_of_study"]
+                context_sentence = "I am "
+                if level or role: 
+                    context_sentence += f"a(n) {level.rstrip().lower()} {role.rstrip().lower()} "
+                if affiliation: 
+                    context_sentence += f"from {affiliation.rstrip()}. "
+
+                if role or affiliation or level: 
+                    search_query = context_sentence+search_query
+            
+            logger.info(f"Entering vector search with query text: {search_query}")
+            vector = await self.timed("embed", self.embed_query(search_query))
+
+        if not text_search:
+            query_text = None
 
-            results = await self.searcher.search(query_text, vector, top, embedding_type=self.embedding_type)
+        return await self.search_and_rerank(query_text, vector, rerank_query, top)
 
-            sources_content = [f"[{(doc.doc_id)}]: {doc.to_str_for_rag()}\n\n" for doc in results]
+
+    async def build_final_query(self, original_user_query, past_messages, search_query, to_greet, is_farewell, is_relevant, no_answer, vector_search, text_search, top, response_token_limit=1024, retrieval=None):
+        """
+        Builds the messages for the final model call. `retrieval` takes the (query_text, results) pair of a retrieval 
+        that was already run (e.g. speculatively by the concurrent pipeline), otherwise retrieval is run here. 
+        """
+        sources_content, query_text, results = None, None, None 
+        
+        if is_relevant: 
+            if retrieval is None: 
+                retrieval = await self.retrieve(search_query, vector_search, text_search, top)
+            query_text, results = retrieval
+
+            user_prefix = original_user_query + "\n\nUser Context:\n" + self.state.user_context + "\n\nSources:\n"
+            max_tokens = self.chat_token_limit - response_token_limit
+            sources_content, results, sources_tokens = self.pack_sources(results, self.rag_answer_prompt_template, user_prefix, max_tokens)
             content = "\n".join(sources_content)
-            global_storage.rag_results.append(content)
+            self.state.add_rag_result(content)
 
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.rag_answer_prompt_template,
-                new_user_content=original_user_query + "\n\nUser Context:\n" + global_storage.user_context + "\n\nSources:\n" + content,
+                new_user_content=user_prefix + content,
                 past_messages=past_messages,
-                max_tokens=self.chat_token_limit - response_token_limit,
+                max_tokens=max_tokens,
                 fallback_to_default=True,
+                # Sum of cached counts, so the sources block is not tokenised again 
+                new_user_tokens=self.token_counter.count_text(user_prefix) + sources_tokens, 
             )
 
         elif to_greet:
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.greeting_prompt_template,
                 new_user_content=original_user_query, 
@@ -633,7 +1105,7 @@ class QueryRewriterRAG(AdvancedRAGChat):
             )
 
         elif is_farewell:
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model = self.chat_model,
                 system_prompt = self.farewell_prompt_template,
                 new_user_content = original_user_query,
@@ -644,7 +1116,7 @@ class QueryRewriterRAG(AdvancedRAGChat):
         # If the model decides the query is out of scope 
         else: 
             no_answer = True
-            messages = build_messages(
+            messages = self.token_counter.build_messages(
                 model=self.chat_model,
                 system_prompt=self.no_answer_prompt_template,
                 new_user_content=original_user_query, 
@@ -655,14 +1127,86 @@ class QueryRewriterRAG(AdvancedRAGChat):
         return messages, sources_content, query_text, results 
     
 
+    async def rewrite_and_retrieve(self, original_user_query, past_messages, vector_search, text_search, top): 
+        """
+        Rewrites the search query and immediately starts retrieval with it. Used by the concurrent pipeline so that 
+        retrieval does not wait for the classification call. 
+        """
+        search_query = await self.within_budget("rewrite", self.rewrite_search_query(original_user_query, past_messages, past_n=1), original_user_query)
+        logger.info(f"Rewritten Query: {search_query}")
+
+        if await self.lookup_answer_cache(search_query, vector_search) is not None: 
+            return search_query, None
+
+        retrieval = await self.timed("retrieve", self.retrieve(search_query, vector_search, text_search, top))
+
+        return search_query, retrieval
+
+
+    async def classify_and_retrieve_concurrently(self, original_user_query, past_messages, vector_search, text_search, top, query_response_token_limit=500): 
+        """
+        Classifies the original user query while the query is rewritten and retrieval runs speculatively. The 
+        speculative retrieval is cancelled if the query turns out to be a greeting, farewell or irrelevant. 
+        """
+        retrieval_task = asyncio.create_task(self.rewrite_and_retrieve(original_user_query, past_messages, vector_search, text_search, top))
+
+        try: 
+            # Without a classification the query is assumed to be relevant 
+            to_greet, is_relevant, is_farewell = await self.within_budget("classify", self.classify_query(original_user_query, past_messages, query_response_token_limit), (False, True, False))
+        except BaseException: 
+            retrieval_task.cancel()
+            await asyncio.gather(retrieval_task, return_exceptions=True)
+            raise
+
+        if is_relevant: 
+            search_query, retrieval = await retrieval_task
+        else: 
+            logger.info("Query not relevant, cancelling speculative retrieval")
+            retrieval_task.cancel()
+            await asyncio.gather(retrieval_task, return_exceptions=True)
+            search_query, retrieval = original_user_query, None 
+            self.cached_response = None # Cached answers are only valid for relevant queries 
+
+        return search_query, retrieval, to_greet, is_relevant, is_farewell
+
+
     async def classify_and_build_message_wrapper(self, original_user_query, past_messages, vector_search, text_search, top, query_response_token_limit=500, response_token_limit=1024):
-        # Rewrite search query based on chat history to capture follow up questions 
-        search_query = await self.rewrite_search_query(original_user_query, past_messages, past_n=1)
+        start = time.monotonic()
+
+        rewrite_classify_mode = self.rewrite_classify_mode()
+        self.rewrite_classify_arm = rewrite_classify_mode
+        logger.info(f"Rewrite/classify mode: {rewrite_classify_mode}")
+
+        if rewrite_classify_mode == "combined": 
+            # Without a classification the query is assumed to be relevant 
+            search_query, to_greet, is_relevant, is_farewell = await self.within_budget(
+                "rewrite_classify", 
+                self.rewrite_and_classify(original_user_query, past_messages, past_n=1, query_response_token_limit=query_response_token_limit), 
+                (original_user_query, False, True, False), 
+            )
+            logger.info(f"Rewritten Query: {search_query}")
+
+            if is_relevant and await self.lookup_answer_cache(search_query, vector_search) is not None: 
+                return None, None, None, None
+            retrieval = None 
+        elif self.concurrent_pipeline: 
+            search_query, retrieval, to_greet, is_relevant, is_farewell = await self.classify_and_retrieve_concurrently(original_user_query, past_messages, vector_search, text_search, top, query_response_token_limit)
+            if self.cached_response is not None: 
+                return None, None, None, None
+        else: 
+            # Rewrite search query based on chat history to capture follow up questions 
+            search_query = await self.within_budget("rewrite", self.rewrite_search_query(original_user_query, past_messages, past_n=1), original_user_query)
 
-        logger.info(f"Rewritten Query: {search_query}")
-        
-        # Classify user query before deciding how to handle the query (e.g. use RAG)
-        to_greet, is_relevant, is_farewell = await self.classify_query(search_query, past_messages, query_response_token_limit)
+            logger.info(f"Rewritten Query: {search_query}")
+
+            # A cached answer means that the query was classified as relevant before 
+            if await self.lookup_answer_cache(search_query, vector_search) is not None: 
+                return None, None, None, None
+            
+            # Classify user query before deciding how to handle the query (e.g. use RAG)
+            # Without a classification the query is assumed to be relevant 
+            to_greet, is_relevant, is_farewell = await self.within_budget("classify", self.classify_query(search_query, past_messages, query_response_token_limit), (False, True, False))
+            retrieval = None 
         no_answer = None
 
         messages, sources_content, query_text, results = await self.build_final_query(
@@ -676,7 +1220,11 @@ class QueryRewriterRAG(AdvancedRAGChat):
                                                             vector_search, 
                                                             text_search, 
                                                             top, 
-                                                            response_token_limit
+                                                            response_token_limit, 
+                                                            retrieval
                                                         )
+
+        self.timings["pre_generation"] = round(time.monotonic() - start, 3)
+        logger.info(f"Stage timings: {self.timings}")
         
         return messages, sources_content, query_text, results 
\ No newline at end of file
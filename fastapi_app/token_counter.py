@@ -0,0 +1,86 @@
+import unicodedata
+
+from chatlse.lru import LRUCache
+from chatlse.tokens import CHUNK_TOKEN_ENCODING, get_encoding
+
+# Tokens added to each message on top of its role and content (openai_messages_token_helper counts 3 per message
+# and 3 for the reply priming)
+MESSAGE_OVERHEAD = 6
+
+
+class TokenCounter:
+    """
+    Drop-in replacement for `openai_messages_token_helper.build_messages` that memoises token counts. Prompt templates
+    are counted once (see `warm`), past messages once per conversation, and sources are counted from the `token_count`
+    stored for each chunk at ingestion, so fitting the context sums cached counts instead of re-running the tokenizer.
+    """
+
+    def __init__(self, model: str, max_size: int = 10000):
+        self.encoding = get_encoding(model)
+        self.max_size = max_size
+        self._counts = LRUCache(max_size)
+
+    def count_text(self, text: str) -> int:
+        count = self._counts.get(text)
+        if count is None:
+            count = len(self.encoding.encode(text))
+            self._counts.set(text, count)
+        return count
+
+    def warm(self, texts):
+        for text in texts:
+            self.count_text(text)
+
+    def count_message(self, message: dict) -> int:
+        return MESSAGE_OVERHEAD + self.count_text(message["role"]) + self.count_text(message["content"])
+
+    def count_chunk(self, doc) -> int:
+        """
+        Count of `doc.to_str_for_rag()`, the one stored at ingestion if it was computed with the same encoding as the
+        chat model's.
+        """
+        if doc.token_count is not None and self.encoding.name == CHUNK_TOKEN_ENCODING:
+            return doc.token_count
+        return self.count_text(doc.to_str_for_rag())
+
+    def build_messages(
+        self,
+        model: str | None = None,
+        system_prompt: str = "",
+        *,
+        new_user_content: str | None = None,
+        past_messages: list[dict] = [],
+        max_tokens: int,
+        fallback_to_default: bool = True,
+        new_user_tokens: int | None = None,
+    ) -> list[dict]:
+        """
+        Same messages as `openai_messages_token_helper.build_messages`: the system prompt, then as many of the most
+        recent `past_messages` as fit in `max_tokens`, then the new user message. `new_user_tokens` is the (estimated)
+        token count of the new user content if the caller already knows it. `model` and `fallback_to_default` are
+        accepted for compatibility, the counter's model is always used.
+        """
+        system_message = {"role": "system", "content": unicodedata.normalize("NFC", system_prompt)}
+        total_token_count = self.count_message(system_message)
+
+        user_messages = []
+        if new_user_content:
+            user_message = {"role": "user", "content": unicodedata.normalize("NFC", new_user_content)}
+            user_messages.append(user_message)
+            if new_user_tokens is None:
+                total_token_count += self.count_message(user_message)
+            else:
+                total_token_count += MESSAGE_OVERHEAD + self.count_text("user") + new_user_tokens
+
+        history = []
+        for message in reversed(past_messages):
+            if message["role"] is None or message["content"] is None:
+                raise ValueError("Past messages must have both role and content")
+            message = {"role": message["role"], "content": unicodedata.normalize("NFC", message["content"])}
+            potential_message_count = self.count_message(message)
+            if total_token_count + potential_message_count > max_tokens:
+                break
+            history.insert(0, message)
+            total_token_count += potential_message_count
+
+        return [system_message] + history + user_messages
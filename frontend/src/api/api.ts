@@ -2,8 +2,9 @@ const BACKEND_URI = "";
 
 import { ChatAppRequest } from "./models";
 
-export async function chatApi(request: ChatAppRequest): Promise<Response> {
-    return await fetch(`${BACKEND_URI}/chat`, {
+export async function chatApi(request: ChatAppRequest, shouldStream: boolean): Promise<Response> {
+    const url = shouldStream ? `${BACKEND_URI}/chat/stream` : `${BACKEND_URI}/chat`;
+    return await fetch(url, {
         method: "POST",
         headers: {
             "Content-Type": "application/json"
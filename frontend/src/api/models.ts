@@ -46,11 +46,13 @@ export type ResponseChoice = {
 
 export type ChatAppResponseOrError = {
     choices?: ResponseChoice[];
+    conversation_id?: string;
     error?: string;
 };
 
 export type ChatAppResponse = {
     choices: ResponseChoice[];
+    conversation_id?: string;
 };
 
 export type ChatAppRequestContext = {
@@ -61,4 +63,5 @@ export type ChatAppRequestContext = {
 export type ChatAppRequest = {
     messages: ResponseMessage[];
     context?: ChatAppRequestContext;
+    conversation_id?: string;
 };
\ No newline at end of file
@@ -1,5 +1,5 @@
 import { useRef, useState, useEffect } from "react";
-import { Panel, DefaultButton, TextField, SpinButton, Slider } from "@fluentui/react";
+import { Panel, DefaultButton, TextField, SpinButton, Slider, Checkbox } from "@fluentui/react";
 import { SparkleFilled } from "@fluentui/react-icons";
 import readNDJSONStream from "ndjson-readablestream";
 
@@ -32,6 +32,7 @@ const Chat = () => {
     const [temperature, setTemperature] = useState<number>(0.3);
     const [retrieveCount, setRetrieveCount] = useState<number>(3);
     const [retrievalMode, setRetrievalMode] = useState<RetrievalMode>(RetrievalMode.Hybrid);
+    const [shouldStream, setShouldStream] = useState<boolean>(true);
 
     const lastQuestionRef = useRef<string>("");
     const chatMessageStreamEnd = useRef<HTMLDivElement | null>(null);
@@ -46,6 +47,38 @@ const Chat = () => {
     const [selectedAnswer, setSelectedAnswer] = useState<number>(0);
     const [answers, setAnswers] = useState<[user: string, response: ChatAppResponse][]>([]);
     const [streamedAnswers, setStreamedAnswers] = useState<[user: string, response: ChatAppResponse][]>([]);
+    // Returned by the backend on the first turn and sent back on every following turn
+    const [conversationId, setConversationId] = useState<string | undefined>(undefined);
+
+    const handleAsyncRequest = async (question: string, answers: [string, ChatAppResponse][], responseBody: ReadableStream<any>) => {
+        let answer: string = "";
+        let askResponse: ChatAppResponse = {} as ChatAppResponse;
+
+        const withAnswer = (content: string): ChatAppResponse => ({
+            ...askResponse,
+            choices: [{ ...askResponse.choices[0], message: { content: content, role: "assistant" } }]
+        });
+
+        try {
+            setIsStreaming(true);
+            for await (const event of readNDJSONStream(responseBody)) {
+                if (event["error"]) {
+                    throw Error(event["error"]);
+                } else if (event["conversation_id"]) {
+                    // The first event carries the conversation id and the retrieval context
+                    askResponse = event as ChatAppResponse;
+                    setConversationId(event["conversation_id"]);
+                } else if (event["choices"] && event["choices"][0]["delta"]["content"]) {
+                    setIsLoading(false);
+                    answer += event["choices"][0]["delta"]["content"];
+                    setStreamedAnswers([...answers, [question, withAnswer(answer)]]);
+                }
+            }
+        } finally {
+            setIsStreaming(false);
+        }
+        return withAnswer(answer);
+    };
 
     const makeApiRequest = async (question: string) => {
         lastQuestionRef.current = question;
@@ -76,16 +109,23 @@ const Chat = () => {
                         temperature: temperature
                     }
                 },
+                conversation_id: conversationId
             };
-            const response = await chatApi(request);
+            const response = await chatApi(request, shouldStream);
             if (!response.body) {
                 throw Error("No response body");
             }
-            const parsedResponse: ChatAppResponseOrError = await response.json();
-            if (response.status > 299 || !response.ok) {
-                throw Error(parsedResponse.error || "Unknown error");
+            if (shouldStream && response.ok) {
+                const parsedResponse: ChatAppResponse = await handleAsyncRequest(question, answers, response.body);
+                setAnswers([...answers, [question, parsedResponse]]);
+            } else {
+                const parsedResponse: ChatAppResponseOrError = await response.json();
+                if (response.status > 299 || !response.ok) {
+                    throw Error(parsedResponse.error || "Unknown error");
+                }
+                setConversationId(parsedResponse.conversation_id);
+                setAnswers([...answers, [question, parsedResponse as ChatAppResponse]]);
             }
-            setAnswers([...answers, [question, parsedResponse as ChatAppResponse]]);
         } catch (e) {
             setError(e);
         } finally {
@@ -100,6 +140,7 @@ const Chat = () => {
         setActiveAnalysisPanelTab(undefined);
         setAnswers([]);
         setStreamedAnswers([]);
+        setConversationId(undefined);
         setIsLoading(false);
         setIsStreaming(false);
     };
@@ -123,6 +164,10 @@ const Chat = () => {
         setRetrieveCount(parseInt(newValue || "3"));
     };
 
+    const onShouldStreamChange = (_ev?: React.FormEvent<HTMLElement | HTMLInputElement>, checked?: boolean) => {
+        setShouldStream(!!checked);
+    };
+
 
     /* const onExampleClicked = (example: string) => {
         makeApiRequest(example);
@@ -325,6 +370,13 @@ const Chat = () => {
                         snapToStep
                     />
 
+                    <Checkbox
+                        className={styles.chatSettingsSeparator}
+                        checked={shouldStream}
+                        label="Stream chat completion responses"
+                        onChange={onShouldStreamChange}
+                    />
+
                 </Panel>
             </div>
         </div>
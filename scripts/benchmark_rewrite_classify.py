@@ -0,0 +1,130 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+import httpx
+import openai
+from dotenv import load_dotenv
+
+from chatlse.clients import create_embed_client
+from chatlse.postgres_engine import create_postgres_engine_from_env
+
+# fastapi_app is not an installed package, it is imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fastapi_app.conversation_store import ConversationState, new_conversation_id
+from fastapi_app.postgres_searcher import PostgresSearcher
+from fastapi_app.prompt_registry import PromptRegistry
+from fastapi_app.rag_advanced import QueryRewriterRAG
+
+logger = logging.getLogger("ragapp")
+
+MODES = ["separate", "combined"]
+FLAGS = ["is_greeting", "is_relevant", "is_farewell"]
+
+
+def load_cases(path):
+    """
+    Reads the labelled turns, one JSON object per line:
+    {"messages": [{"role": ..., "content": ...}, ...], "is_greeting": bool, "is_relevant": bool, "is_farewell": bool,
+     "doc_ids": [doc_id of the chunks that answer the last message, optional]}
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+async def run_case(ragchat, case, mode, top):
+    original_user_query = case["messages"][-1]["content"]
+    past_messages = case["messages"][:-1]
+
+    if mode == "combined":
+        search_query, to_greet, is_relevant, is_farewell = await ragchat.rewrite_and_classify(original_user_query, past_messages)
+    else:
+        search_query = await ragchat.rewrite_search_query(original_user_query, past_messages, past_n=1)
+        to_greet, is_relevant, is_farewell = await ragchat.classify_query(search_query, past_messages)
+
+    doc_ids = []
+    if is_relevant and case.get("doc_ids"):
+        _, results = await ragchat.retrieve(search_query, vector_search=True, text_search=True, top=top)
+        doc_ids = [doc.doc_id for doc in results]
+
+    return {"is_greeting": to_greet, "is_relevant": is_relevant, "is_farewell": is_farewell}, doc_ids
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Compare separate and combined query rewriting and classification")
+    parser.add_argument(
+        "cases", nargs="?", default=os.path.join(os.path.dirname(__file__), "benchmark_rewrite_classify_cases.jsonl"),
+        help="JSONL file of labelled conversation turns (default: benchmark_rewrite_classify_cases.jsonl next to this script)",
+    )
+    parser.add_argument("--mode", choices=MODES, action="append", help="Mode to benchmark (default: both)")
+    parser.add_argument("--top", type=int, default=3, help="Number of chunks retrieved per query")
+    args = parser.parse_args()
+
+    cases = load_cases(args.cases)
+
+    # Count every request made to the chat model
+    llm_calls = 0
+
+    async def count_request(request):
+        nonlocal llm_calls
+        llm_calls += 1
+
+    chat_client = openai.AsyncOpenAI(
+        base_url=os.getenv("OLLAMA_ENDPOINT"),
+        api_key="nokeyneeded",
+        http_client=httpx.AsyncClient(event_hooks={"request": [count_request]}),
+    )
+    engine = await create_postgres_engine_from_env()
+    prompts = PromptRegistry()
+    prompts.load()
+    embed_model = await create_embed_client()
+
+    ragchat = QueryRewriterRAG(
+        searcher=PostgresSearcher(engine),
+        prompts=prompts,
+        state=ConversationState(conversation_id=new_conversation_id()),
+        chat_client=chat_client,
+        chat_model=os.getenv("OLLAMA_CHAT_MODEL"),
+        embed_model=embed_model,
+        embed_dimensions=None,
+        context_window_override=None,
+        to_summarise=False,
+        embedding_type=os.getenv("EMBEDDING_TYPE", "title_embeddings"),
+    )
+
+    for mode in args.mode or MODES:
+        llm_calls = 0
+        correct = {flag: 0 for flag in FLAGS}
+        hits, retrieval_cases = 0, 0
+        start = time.monotonic()
+
+        for case in cases:
+            decision, doc_ids = await run_case(ragchat, case, mode, args.top)
+            for flag in FLAGS:
+                correct[flag] += decision[flag] == case[flag]
+            if case.get("doc_ids") and case["is_relevant"]:
+                retrieval_cases += 1
+                hits += any(doc_id in case["doc_ids"] for doc_id in doc_ids)
+
+        elapsed = time.monotonic() - start
+        print(f"== {mode} ==")
+        for flag in FLAGS:
+            print(f"{flag} accuracy: {correct[flag] / len(cases):.3f}")
+        if retrieval_cases:
+            print(f"hit rate @{args.top}: {hits / retrieval_cases:.3f} ({retrieval_cases} queries)")
+        # Excluding the answer generation call, which is the same in both modes
+        print(f"LLM calls per turn (before generation): {llm_calls / len(cases):.2f}")
+        print(f"Mean latency per turn: {elapsed / len(cases):.3f}s\n")
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.WARNING)
+    load_dotenv(override=True)
+    asyncio.run(main())
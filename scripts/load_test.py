@@ -0,0 +1,361 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+
+import httpx
+import numpy as np
+import openai
+import uvicorn
+from dotenv import load_dotenv
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# fastapi_app is not an installed package, it is imported from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fastapi_app
+from chatlse.clients import BoundedChatClient
+
+logger = logging.getLogger("ragapp")
+
+FILLER_WORDS = ["students", "can", "apply", "through", "the", "LSE", "for", "Life", "portal", "before", "deadline", "and"]
+
+
+def load_conversations(path):
+    """
+    Reads one conversation per line. The user turns are taken from "messages" (as sent to /chat, assistant messages
+    are replaced by the app's answers) or "turns" (list of strings), otherwise the "body" of the line is replayed as a
+    single turn, so a file of {"request_id": ..., "title": ..., "body": ...} lines can be used as is.
+    """
+    conversations = []
+    with open(path) as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "messages" in record:
+                turns = [message["content"] for message in record["messages"] if message.get("role", "user") == "user"]
+            elif "turns" in record:
+                turns = record["turns"]
+            else:
+                turns = [record["body"]]
+            conversations.append({"id": record.get("request_id") or record.get("id") or str(i), "turns": turns})
+    return conversations
+
+
+class StubEmbedding:
+    """
+    Deterministic stand-in for the HuggingFace embedding model: the vector of a text is drawn from a generator seeded
+    with its hash, so runs are reproducible without loading the model. Retrieval still runs the real queries against
+    Postgres, but the chunks it returns are arbitrary.
+    """
+    model_name = "stub"
+
+    def __init__(self, dimensions: int = 1024):
+        self.dimensions = dimensions
+
+    def get_text_embedding(self, text: str) -> list[float]:
+        seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:16], 16)
+        vector = np.random.default_rng(seed).standard_normal(self.dimensions)
+        return (vector / np.linalg.norm(vector)).tolist()
+
+    def get_text_embedding_batch(self, texts: list[str]) -> list[list[float]]:
+        return [self.get_text_embedding(text) for text in texts]
+
+
+def build_fake_llm(latency: float, tokens_per_second: float, answer_tokens: int) -> FastAPI:
+    """
+    OpenAI-compatible chat completions endpoint standing in for Ollama. Every call waits `latency` seconds, then
+    produces its tokens at `tokens_per_second`. Function calls mark every query as relevant (not a greeting or
+    farewell) and JSON answers return the user query as the rewritten query, so each turn goes through retrieval.
+    """
+    app = FastAPI()
+
+    def completion_id():
+        return f"chatcmpl-{uuid.uuid4().hex[:12]}"
+
+    def answer_text():
+        return " ".join(FILLER_WORDS[i % len(FILLER_WORDS)] for i in range(answer_tokens)) + "."
+
+    def usage(body, completion_tokens):
+        prompt_tokens = sum(len(str(message.get("content") or "")) for message in body["messages"]) // 4
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+    def function_arguments(body):
+        query = next((message["content"] for message in reversed(body["messages"]) if message["role"] == "user"), "")
+        parameters = body["tools"][0]["function"]["parameters"]["properties"]
+        return {
+            name: (query if spec["type"] == "string" else name == "is_relevant")
+            for name, spec in parameters.items()
+        }
+
+    async def stream_answer(body):
+        created = int(time.time())
+        chunk_id = completion_id()
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": chunk_id, "object": "chat.completion.chunk", "created": created, "model": body["model"],
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+
+        await asyncio.sleep(latency)
+        yield f"data: {json.dumps(chunk({'role': 'assistant', 'content': ''}))}\n\n"
+        words = answer_text().split(" ")
+        for i, word in enumerate(words):
+            await asyncio.sleep(1 / tokens_per_second)
+            yield f"data: {json.dumps(chunk({'content': word if i == 0 else ' ' + word}))}\n\n"
+        yield f"data: {json.dumps(chunk({}, 'stop'))}\n\n"
+        if body.get("stream_options", {}).get("include_usage"):
+            usage_chunk = {**chunk({}), "choices": [], "usage": usage(body, len(words))}
+            yield f"data: {json.dumps(usage_chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        if body.get("stream"):
+            return StreamingResponse(stream_answer(body), media_type="text/event-stream")
+
+        message = {"role": "assistant", "content": None}
+        finish_reason = "stop"
+        if body.get("tools"):
+            arguments = json.dumps(function_arguments(body))
+            message["tool_calls"] = [{
+                "id": "call_0", "type": "function",
+                "function": {"name": body["tools"][0]["function"]["name"], "arguments": arguments},
+            }]
+            finish_reason = "tool_calls"
+            completion_tokens = len(arguments) // 4
+        elif body.get("response_format", {}).get("type") == "json_object":
+            message["content"] = json.dumps({"rewritten query": body["messages"][-1]["content"]})
+            completion_tokens = len(message["content"]) // 4
+        else:
+            message["content"] = answer_text()
+            completion_tokens = answer_tokens
+
+        await asyncio.sleep(latency + completion_tokens / tokens_per_second)
+        return JSONResponse({
+            "id": completion_id(), "object": "chat.completion", "created": int(time.time()), "model": body["model"],
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": usage(body, completion_tokens),
+        })
+
+    return app
+
+
+def start_server(app, port: int) -> tuple[uvicorn.Server, threading.Thread]:
+    """
+    Serves `app` from a thread with its own event loop, so that the load generator does not share the app's loop.
+    """
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", lifespan="on"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise SystemExit(f"Server on port {port} failed to start")
+        time.sleep(0.05)
+    return server, thread
+
+
+def stop_server(server: uvicorn.Server, thread: threading.Thread):
+    server.should_exit = True
+    thread.join(timeout=30)
+
+
+def use_local_stand_ins(llm_port: int, chat_model: str, max_concurrency: int, embed_dimensions: int):
+    """
+    Makes the app's `lifespan` create a chat client for the fake LLM server and the stub embedder instead of the
+    Ollama client and the HuggingFace model.
+    """
+    async def create_chat_client():
+        client = openai.AsyncOpenAI(base_url=f"http://127.0.0.1:{llm_port}/v1", api_key="nokeyneeded")
+        return BoundedChatClient(client, max_concurrency=max_concurrency), chat_model
+
+    async def create_embed_client():
+        return StubEmbedding(embed_dimensions)
+
+    fastapi_app.create_chat_client = create_chat_client
+    fastapi_app.create_embed_client = create_embed_client
+
+
+def first_timings(event):
+    try:
+        return event["choices"][0]["context"]["thoughts"][0]["props"].get("timings", {})
+    except (KeyError, IndexError, TypeError):
+        return {}
+
+
+async def play_turn(client, messages, conversation_id, stream, overrides):
+    """
+    Sends one turn. Returns the answer, the conversation id and the measurements of the turn.
+    """
+    payload = {"messages": messages, "context": {"overrides": overrides}, "conversation_id": conversation_id}
+    start = time.monotonic()
+    result = {"ttft": None, "timings": {}}
+
+    if not stream:
+        response = await client.post("/chat", json=payload)
+        response.raise_for_status()
+        chat_resp = response.json()
+        result["latency"] = time.monotonic() - start
+        result["timings"] = first_timings(chat_resp)
+        return chat_resp["choices"][0]["message"]["content"], chat_resp.get("conversation_id"), result
+
+    answer = ""
+    async with client.stream("POST", "/chat/stream", json=payload) as response:
+        response.raise_for_status()
+        async for line in response.aiter_lines():
+            if not line:
+                continue
+            event = json.loads(line)
+            if "error" in event:
+                raise RuntimeError(event["error"])
+            if event.get("conversation_id"):
+                conversation_id = event["conversation_id"]
+                result["timings"] = first_timings(event)
+            if not event.get("choices"):
+                continue
+            content = event["choices"][0]["delta"].get("content")
+            if content:
+                if result["ttft"] is None:
+                    result["ttft"] = time.monotonic() - start
+                answer += content
+    result["latency"] = time.monotonic() - start
+    return answer, conversation_id, result
+
+
+async def play_conversation(client, conversation, stream, overrides, results, errors):
+    messages = []
+    conversation_id = None
+    for turn in conversation["turns"]:
+        messages.append({"role": "user", "content": turn})
+        try:
+            answer, conversation_id, result = await play_turn(client, messages, conversation_id, stream, overrides)
+        except Exception as e:
+            logger.warning(f"Conversation {conversation['id']} failed: {e!r}")
+            errors.append(repr(e))
+            return
+        results.append(result)
+        messages.append({"role": "assistant", "content": answer})
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarise(results, errors, elapsed):
+    latencies = [result["latency"] for result in results]
+    ttfts = [result["ttft"] for result in results if result["ttft"] is not None]
+    stages = defaultdict(list)
+    for result in results:
+        for stage, seconds in result["timings"].items():
+            stages[stage].append(seconds)
+
+    return {
+        "turns": len(results),
+        "errors": len(errors),
+        "elapsed": elapsed,
+        "throughput": len(results) / elapsed if elapsed else 0.0,
+        "latency": {f"p{p}": percentile(latencies, p) for p in (50, 95, 99)},
+        "ttft": {f"p{p}": percentile(ttfts, p) for p in (50, 95, 99)},
+        "stages": {
+            stage: {"count": len(values), "mean": sum(values) / len(values), "p95": percentile(values, 95)}
+            for stage, values in sorted(stages.items())
+        },
+    }
+
+
+def print_report(report):
+    def seconds(value):
+        return "-" if value is None else f"{value:.3f}s"
+
+    print(f"Turns: {report['turns']} ({report['errors']} failed conversations) in {report['elapsed']:.1f}s")
+    print(f"Throughput: {report['throughput']:.2f} turns/s")
+    print("Latency:       " + "  ".join(f"{p} {seconds(value)}" for p, value in report["latency"].items()))
+    print("First token:   " + "  ".join(f"{p} {seconds(value)}" for p, value in report["ttft"].items()))
+    print("\nStage                 count      mean       p95")
+    for stage, stats in report["stages"].items():
+        print(f"{stage:<20} {stats['count']:>6} {seconds(stats['mean']):>9} {seconds(stats['p95']):>9}")
+
+
+async def run_load(args, conversations):
+    queue = asyncio.Queue()
+    for conversation in conversations:
+        queue.put_nowait(conversation)
+
+    results, errors = [], []
+    overrides = json.loads(args.overrides) if args.overrides else {}
+
+    async def user(client):
+        while not queue.empty():
+            conversation = queue.get_nowait()
+            await play_conversation(client, conversation, args.stream, overrides, results, errors)
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{args.port}", timeout=None, limits=limits) as client:
+        start = time.monotonic()
+        await asyncio.gather(*[user(client) for _ in range(args.concurrency)])
+        elapsed = time.monotonic() - start
+
+    return summarise(results, errors, elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay conversations concurrently against the app with a fake LLM and a stub embedder")
+    parser.add_argument("conversations", help="JSONL file of conversations")
+    parser.add_argument("--concurrency", type=int, default=8, help="Number of conversations played at the same time")
+    parser.add_argument("--conversations-total", type=int, default=None, help="Number of conversations to play, cycling through the file (default: each once)")
+    parser.add_argument("--stream", action="store_true", help="Use /chat/stream and measure the time to first token")
+    parser.add_argument("--overrides", default=None, help="JSON overrides sent with every request")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the conversation order")
+    parser.add_argument("--port", type=int, default=8100, help="Port of the app under test")
+    parser.add_argument("--llm-port", type=int, default=11500, help="Port of the fake LLM server")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Seconds before the fake LLM starts answering")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=30.0, help="Generation speed of the fake LLM")
+    parser.add_argument("--answer-tokens", type=int, default=150, help="Length of the fake answers")
+    parser.add_argument("--chat-concurrency", type=int, default=int(os.getenv("CHAT_MAX_CONCURRENCY", 4)), help="Concurrent completions allowed by the app's chat client")
+    parser.add_argument("--embed-dimensions", type=int, default=1024, help="Dimensions of the stub embeddings (1024 for gte-large)")
+    parser.add_argument("--output", default=None, help="Also write the report to this JSON file")
+    args = parser.parse_args()
+
+    conversations = load_conversations(args.conversations)
+    total = args.conversations_total or len(conversations)
+    conversations = [conversations[i % len(conversations)] for i in range(total)]
+    random.Random(args.seed).shuffle(conversations)
+
+    chat_model = os.getenv("OLLAMA_CHAT_MODEL", "llama3.1:8b-instruct-q8_0")
+    llm_server = start_server(build_fake_llm(args.llm_latency, args.llm_tokens_per_second, args.answer_tokens), args.llm_port)
+    use_local_stand_ins(args.llm_port, chat_model, args.chat_concurrency, args.embed_dimensions)
+    app_server = start_server(fastapi_app.create_app(), args.port)
+
+    try:
+        report = asyncio.run(run_load(args, conversations))
+    finally:
+        # The app shuts down first, its lifespan closes the chat client 
+        stop_server(*app_server)
+        stop_server(*llm_server)
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.WARNING)
+    load_dotenv(override=True)
+    main()
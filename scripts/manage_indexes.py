@@ -0,0 +1,65 @@
+import argparse
+import logging
+
+from dotenv import load_dotenv
+
+from chatlse.postgres_engine import create_postgres_engine_from_env_sync
+from chatlse.postgres_indexes import EMBEDDING_COLUMNS, create_fulltext_index, create_hnsw_index, explain_vector_query
+from chatlse.tokens import backfill_token_counts
+
+logger = logging.getLogger("ragapp")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create and check the indexes of the lse_doc table")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("fulltext", help="Add the stored tsvector column and its GIN index (backfills existing rows)")
+
+    hnsw_parser = subparsers.add_parser("hnsw", help="Create the cosine-distance HNSW indexes of the embedding columns")
+    hnsw_parser.add_argument("--column", choices=EMBEDDING_COLUMNS, action="append", help="Embedding column (default: all)")
+    hnsw_parser.add_argument("--m", type=int, default=16, help="Max number of connections per layer")
+    hnsw_parser.add_argument("--ef-construction", type=int, default=64, help="Size of the candidate list when building")
+    hnsw_parser.add_argument("--rebuild", action="store_true", help="Drop existing indexes first so new parameters take effect")
+
+    subparsers.add_parser("token-counts", help="Fill the token_count column of chunks ingested before it existed")
+
+    explain_parser = subparsers.add_parser("explain", help="Check with EXPLAIN that vector queries use the HNSW indexes")
+    explain_parser.add_argument("--column", choices=EMBEDDING_COLUMNS, action="append", help="Embedding column (default: all)")
+    explain_parser.add_argument("--ef-search", type=int, default=None, help="hnsw.ef_search to set before the query")
+
+    args = parser.parse_args()
+
+    engine = create_postgres_engine_from_env_sync()
+    all_indexed = True
+
+    with engine.connect() as conn:
+        if args.command == "fulltext":
+            create_fulltext_index(conn)
+
+        elif args.command == "hnsw":
+            for column in args.column or EMBEDDING_COLUMNS:
+                create_hnsw_index(conn, column, m=args.m, ef_construction=args.ef_construction, rebuild=args.rebuild)
+
+        elif args.command == "token-counts":
+            backfill_token_counts(conn)
+
+        elif args.command == "explain":
+            for column in args.column or EMBEDDING_COLUMNS:
+                uses_index, plan = explain_vector_query(conn, column, ef_search=args.ef_search)
+                all_indexed = all_indexed and uses_index
+                print(f"{column}: {'uses HNSW index' if uses_index else 'DOES NOT use HNSW index'}\n{plan}\n")
+
+    engine.dispose()
+    logger.info('PostgreSQL Connection closed')
+
+    if not all_indexed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    main()
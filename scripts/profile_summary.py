@@ -0,0 +1,56 @@
+import argparse
+import os
+import pstats
+
+from dotenv import load_dotenv
+
+SORT_KEYS = ["cumulative", "tottime", "ncalls"]
+
+
+def find_profile(profile: str, profile_dir: str | None) -> str:
+    """
+    Accepts the path of a profile or the `profile_id` returned by /chat, looked up in `profile_dir`.
+    """
+    if os.path.isfile(profile):
+        return profile
+    path = os.path.join(profile_dir or ".", f"{profile}.prof")
+    if not os.path.isfile(path):
+        raise SystemExit(f"No profile found at {profile} or {path}")
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarise a request profile written by the /chat profiling hook")
+    parser.add_argument("profile", nargs="?", help="Profile id or path (default: the most recent profile)")
+    parser.add_argument("--dir", default=os.getenv("PROFILE_DIR"), help="Profile directory (default: PROFILE_DIR)")
+    parser.add_argument("--sort", choices=SORT_KEYS, default="cumulative", help="Order of the functions")
+    parser.add_argument("--top", type=int, default=25, help="Number of functions to show")
+    parser.add_argument("--filter", default=None, help="Only show functions whose path matches this regex (e.g. fastapi_app)")
+    args = parser.parse_args()
+
+    if args.profile is None:
+        if not args.dir or not os.path.isdir(args.dir):
+            raise SystemExit("Give a profile or a profile directory")
+        profiles = sorted(
+            (os.path.join(args.dir, name) for name in os.listdir(args.dir) if name.endswith(".prof")),
+            key=os.path.getmtime,
+        )
+        if not profiles:
+            raise SystemExit(f"No profiles in {args.dir}")
+        path = profiles[-1]
+    else:
+        path = find_profile(args.profile, args.dir)
+
+    print(f"Profile: {path}")
+    stats = pstats.Stats(path)
+    if args.filter is None:
+        stats.strip_dirs() # Paths are kept when filtering on them
+    stats.sort_stats(args.sort)
+    restrictions = [args.filter, args.top] if args.filter else [args.top]
+    stats.print_stats(*restrictions)
+
+
+if __name__ == "__main__":
+
+    load_dotenv(override=True)
+    main()
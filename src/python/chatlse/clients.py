@@ -1,19 +1,153 @@
 import os
+import time
+import asyncio
 import openai
+import httpx
 import logging
+from types import SimpleNamespace
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
 logger = logging.getLogger("ragapp")
 
 DEFAULT_EMBED_MODEL = "thenlper/gte-large"
 
+# Chat queue waits longer than this (in seconds) are logged as warnings, the others only at debug level
+SLOW_QUEUE_WAIT = 1.0
+
+
+class BoundedStream:
+    """
+    Streamed completion that holds a `BoundedChatClient` slot. The slot is released exactly once: when the stream is
+    exhausted or fails, on `aclose`, or when the object is garbage collected, also if iteration never started.
+    """
+    def __init__(self, stream, release):
+        self._stream = stream
+        self._iterator = None
+        self._release = release
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._release()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._iterator is None:
+            self._iterator = self._stream.__aiter__()
+        try:
+            return await self._iterator.__anext__()
+        except BaseException: # Also StopAsyncIteration and cancellation
+            self.release()
+            raise
+
+    async def aclose(self):
+        try:
+            close = getattr(self._stream, "close", None) or getattr(self._stream, "aclose", None)
+            if close is not None:
+                await close()
+        finally:
+            self.release()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    def __del__(self):
+        self.release()
+
+
+class BoundedChatClient:
+    """
+    Wraps the `openai.AsyncOpenAI` client of one endpoint so that at most `max_concurrency` completions run against it
+    at once. Further calls wait in the semaphore's queue instead of queueing invisibly inside Ollama, and the time
+    spent waiting is recorded. Exposes the same `chat.completions.create` as the wrapped client. Streamed completions
+    hold their slot until the stream has been consumed or closed.
+    """
+    def __init__(self, client: openai.AsyncOpenAI, max_concurrency: int = 4, timeout: float | None = None):
+        self.client = client
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout # Default per-call timeout in seconds, the client's own if None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.waiting = 0
+        self.count = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def _acquire(self):
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        wait = time.monotonic() - start
+        self.in_flight += 1
+        self.count += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        if wait > SLOW_QUEUE_WAIT:
+            logger.warning(f"Slow chat queue wait: {wait:.4f}s (in flight: {self.in_flight}/{self.max_concurrency}, waiting: {self.waiting})")
+        else:
+            logger.debug(f"Chat queue wait: {wait:.4f}s")
+
+    def _release(self):
+        self.in_flight -= 1
+        self._semaphore.release()
+
+    async def create(self, **kwargs):
+        if self.timeout is not None:
+            kwargs.setdefault("timeout", self.timeout)
+
+        await self._acquire()
+        try:
+            response = await self.client.chat.completions.create(**kwargs)
+        except BaseException:
+            self._release()
+            raise
+
+        if kwargs.get("stream"):
+            return BoundedStream(response, self._release)
+        self._release()
+        return response
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "count": self.count,
+            "mean_wait": self.total_wait / self.count if self.count else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+    async def close(self):
+        await self.client.close()
+
 
 async def create_chat_client():
     logger.info("Creating Ollama Chat Client") 
-    chat_client = openai.AsyncOpenAI(
+    max_concurrency = int(os.getenv("CHAT_MAX_CONCURRENCY", 4))
+    # Keep-alive connections are reused between calls, one per concurrent completion is enough
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=int(os.getenv("CHAT_POOL_MAX_CONNECTIONS", max_concurrency * 2)),
+            max_keepalive_connections=max_concurrency,
+            keepalive_expiry=float(os.getenv("CHAT_KEEPALIVE_EXPIRY", 60)),
+        ),
+        timeout=httpx.Timeout(float(os.getenv("CHAT_TIMEOUT", 120)), connect=float(os.getenv("CHAT_CONNECT_TIMEOUT", 5))),
+    )
+    client = openai.AsyncOpenAI(
         base_url=os.getenv("OLLAMA_ENDPOINT"),
         api_key="nokeyneeded",
+        http_client=http_client,
     )
+    chat_client = BoundedChatClient(client, max_concurrency=max_concurrency, timeout=float(os.getenv("CHAT_TIMEOUT", 120)))
     chat_model = os.getenv("OLLAMA_CHAT_MODEL")
     
     return chat_client, chat_model
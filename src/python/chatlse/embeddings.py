@@ -1,11 +1,21 @@
 # This file contains util functions for embeddings
 import os 
 import json
+import re
+import array
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import openai
 from openai_messages_token_helper import build_messages
 
 from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
+from chatlse.lru import LRUCache
+
 # Filter unnecessary FutureWarning thrown by HuggingFaceEmbedding
 import warnings
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -20,14 +30,175 @@ CHAT_MODEL = os.getenv("OLLAMA_CHAT_MODEL")
 EMBED_MODEL = os.getenv("OLLAMA_EMBED_MODEL")
 
 
+logger = logging.getLogger("ragapp")
+
+
+#### Embedding Service #### 
+
+class EmbeddingService: 
+    """
+    Runs query embeddings in a dedicated worker thread so that the forward pass never blocks the event loop. 
+    Queries that arrive within `max_wait_ms` of each other are encoded together in one batch of at most 
+    `max_batch_size` texts, callers get their embedding back through a future. 
+    """
+    def __init__(self, model_instance: HuggingFaceEmbedding, max_batch_size: int = 16, max_wait_ms: float = 5.0): 
+        self.model_instance = model_instance
+        self.model_name = model_instance.model_name
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue: asyncio.Queue | None = None
+        self._worker: asyncio.Task | None = None
+        # A single thread: torch already parallelises one forward pass across cores 
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="embedding")
+
+    async def start(self): 
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.create_task(self._run())
+        logger.info(f"Embedding service started (max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait * 1000})")
+
+    async def stop(self): 
+        if self._worker: 
+            self._worker.cancel()
+            await asyncio.gather(self._worker, return_exceptions=True)
+        self._executor.shutdown(wait=False)
+
+    async def embed(self, text: str) -> list[float]: 
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        return await future
+
+    async def _collect_batch(self): 
+        loop = asyncio.get_running_loop()
+        batch = [await self._queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size: 
+            timeout = deadline - loop.time()
+            if timeout <= 0: 
+                break
+            try: 
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError: 
+                break
+        # Skip requests whose caller has gone away in the meantime 
+        return [(text, future) for text, future in batch if not future.done()]
+
+    async def _run(self): 
+        loop = asyncio.get_running_loop()
+        while True: 
+            batch = await self._collect_batch()
+            if not batch: 
+                continue
+            try: 
+                embeddings = await loop.run_in_executor(
+                    self._executor, self.model_instance.get_text_embedding_batch, [text for text, _ in batch]
+                )
+            except Exception as e: 
+                for _, future in batch: 
+                    if not future.done(): 
+                        future.set_exception(e)
+            else: 
+                for (_, future), embedding in zip(batch, embeddings): 
+                    if not future.done(): 
+                        future.set_result(embedding)
+
+
+#### Embedding Cache #### 
+
+def normalise_query(q: str) -> str: 
+    return re.sub(r"\s+", " ", q).strip().lower()
+
+
+class EmbeddingCache: 
+    """
+    Bounded LRU cache of query embeddings keyed by the normalised query text and the embedding model name. 
+    If `disk_path` is given, evicted and new entries are also kept in a SQLite file so that they survive restarts. 
+    """
+    def __init__(self, max_size: int = 10000, disk_path: str | None = None, max_disk_size: int = 1000000): 
+        self.max_size = max_size
+        self.max_disk_size = max_disk_size
+        self._entries = LRUCache(max_size)
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._disk = None
+        if disk_path: 
+            self._disk_lock = threading.Lock()
+            self._disk = sqlite3.connect(disk_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS query_embeddings (key TEXT PRIMARY KEY, embedding BLOB)")
+            self._disk.commit()
+
+    @staticmethod
+    def make_key(q: str, model_name: str) -> str: 
+        return hashlib.sha1(f"{model_name}\x00{normalise_query(q)}".encode("utf-8")).hexdigest()
+
+    def _disk_get(self, key: str): 
+        with self._disk_lock: 
+            row = self._disk.execute("SELECT embedding FROM query_embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None: 
+            return None
+        return array.array("f", row[0]).tolist()
+
+    def _disk_set(self, key: str, embedding: list[float]): 
+        with self._disk_lock: 
+            self._disk.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, embedding) VALUES (?, ?)", 
+                (key, array.array("f", embedding).tobytes()), 
+            )
+            # Drop the oldest rows once the file holds more than `max_disk_size` entries 
+            self._disk.execute(
+                "DELETE FROM query_embeddings WHERE rowid <= (SELECT MAX(rowid) FROM query_embeddings) - ?", 
+                (self.max_disk_size,), 
+            )
+            self._disk.commit()
+
+    async def get(self, q: str, model_name: str) -> list[float] | None: 
+        key = self.make_key(q, model_name)
+        embedding = self._entries.get(key)
+        if embedding is not None: 
+            self.hits += 1
+            return embedding
+        if self._disk is not None: 
+            embedding = await asyncio.to_thread(self._disk_get, key)
+            if embedding is not None: 
+                self._entries.set(key, embedding)
+                self.disk_hits += 1
+                return embedding
+        self.misses += 1
+        return None
+
+    async def set(self, q: str, model_name: str, embedding: list[float]): 
+        key = self.make_key(q, model_name)
+        self._entries.set(key, embedding)
+        if self._disk is not None: 
+            await asyncio.to_thread(self._disk_set, key, embedding)
+
+    def stats(self) -> dict: 
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "size": len(self._entries), 
+            "hits": self.hits, 
+            "disk_hits": self.disk_hits, 
+            "misses": self.misses, 
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0, 
+        }
+
+    def close(self): 
+        if self._disk is not None: 
+            self._disk.close()
+
+
 #### Util Functions #### 
 
 async def compute_text_embedding(
     q: str, embed_model: str = EMBED_MODEL, model_instance=None
 ):
+    if isinstance(model_instance, EmbeddingService): 
+        return await model_instance.embed(q)
     if not model_instance:
         model_instance = HuggingFaceEmbedding(model_name=embed_model) 
-    embedding = model_instance.get_text_embedding(q)
+    # Run the forward pass in a thread to keep the event loop responsive 
+    embedding = await asyncio.to_thread(model_instance.get_text_embedding, q)
 
     return embedding
 
@@ -44,6 +44,17 @@ def extract_json_query_rewriter(chat_response: ChatCompletion):
 
 
 
+def extract_json_rewrite_and_classify(chat_response: ChatCompletion):
+    rewritten_query = extract_function_calls(chat_response, "rewritten_query") # Search query rewritten with the conversation history 
+    to_greet, is_relevant, is_farewell = extract_json_query_rewriter(chat_response)
+
+    if not isinstance(rewritten_query, str): 
+        rewritten_query = None
+
+    return rewritten_query, to_greet, is_relevant, is_farewell
+
+
+
 def parse_type(obj):
     if type(obj) != bool:
         return obj.lower() == "true"
@@ -170,3 +181,41 @@ def build_filter_function_query_rewriter() -> list[ChatCompletionToolParam]:
         },
     }     
 ]
+
+
+
+def build_rewrite_and_classify_function() -> list[ChatCompletionToolParam]:
+    return [
+        {
+        "type": "function",
+        "function": {
+            "name": "rewrite_and_filter_query",
+            "description": '''Rewrite the last user query into a standalone search query and decide whether the model should answer it by judging whether it is in scope.
+                    Respond in the format: {"rewritten_query": "...", "is_greeting": true/false, "is_relevant": true/false, "is_farewell": true/false}
+                    Do NOT enclose the true or false values in quotes.''',
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "rewritten_query": {
+                        "type": "string",
+                        "description": "The last user query rewritten to include the information it refers to from the previous messages. If it does not refer to previous messages, the original query unchanged. Do NOT answer the query.",
+                    },
+                    "is_greeting": {
+                        "type": "boolean",
+                        "description": "Based ONLY on the last user query, decide if the query is a greeting, e.g. Hi, Hello, How are you, What's up, Sup etc.",
+                    },
+                    "is_relevant": {
+                        "type": "boolean",
+                        "description": "You are an assistant at the London School fo Economics (LSE). Your job is to answer any administrative questions that the staff and students may have. You must also handle all mental health related queries. Based on the rewritten query, decide if you should answer the user query provided. If the statement is purely conversational (e.g. thanks, bye, etc.), it is not relevant. If you are unsure, answer true.",
+                    },
+                    "is_farewell": {
+                        "type": "boolean",
+                        "description": '''Based ONLY on the last user query, decide if the user query suggests the termination of the conversation or that they no longer require your help.
+                        E.g. Perfect, Thank you, Thanks, Great, Bye, Goodbye, Thank you for your help, etc.''',
+                    },
+                },
+                "required": ["rewritten_query", "is_greeting", "is_relevant", "is_farewell"],
+            },
+        },
+    }     
+]
@@ -7,7 +7,10 @@ from sqlalchemy import Engine, create_engine
 logger = logging.getLogger("ragapp")
 
 
-async def create_postgres_engine(*, host, port, username, database, password, sslmode) -> AsyncEngine:
+async def create_postgres_engine(
+    *, host, port, username, database, password, sslmode, 
+    pool_size=5, max_overflow=10, pool_timeout=30, pool_pre_ping=True, pool_recycle=1800, statement_cache_size=100
+) -> AsyncEngine:
     
     logger.info("Authenticating to PostgreSQL using password...")
 
@@ -19,6 +22,13 @@ async def create_postgres_engine(*, host, port, username, database, password, ss
     engine = create_async_engine(
         DATABASE_URI,
         echo=False,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        pool_timeout=pool_timeout,
+        pool_pre_ping=pool_pre_ping,
+        pool_recycle=pool_recycle,
+        # Number of prepared statements asyncpg keeps per connection 
+        connect_args={"prepared_statement_cache_size": statement_cache_size},
     )
 
     return engine
@@ -32,7 +42,13 @@ async def create_postgres_engine_from_env() -> AsyncEngine:
         username=os.environ["POSTGRES_USERNAME"],
         database=os.environ["POSTGRES_DATABASE"],
         password=os.environ["POSTGRES_PASSWORD"],
-        sslmode=os.environ.get("POSTGRES_SSL")
+        sslmode=os.environ.get("POSTGRES_SSL"),
+        pool_size=int(os.environ.get("POSTGRES_POOL_SIZE", 5)),
+        max_overflow=int(os.environ.get("POSTGRES_MAX_OVERFLOW", 10)),
+        pool_timeout=float(os.environ.get("POSTGRES_POOL_TIMEOUT", 30)),
+        pool_pre_ping=os.environ.get("POSTGRES_POOL_PRE_PING", "True").lower() == "true",
+        pool_recycle=int(os.environ.get("POSTGRES_POOL_RECYCLE", 1800)),
+        statement_cache_size=int(os.environ.get("POSTGRES_STATEMENT_CACHE_SIZE", 100)),
     )
 
     return engine
@@ -0,0 +1,103 @@
+# This file contains util functions to manage the indexes of the lse_doc table
+import logging
+
+from sqlalchemy import Connection, text
+
+logger = logging.getLogger("ragapp")
+
+
+#### Full-text search ####
+
+# Expression behind the stored `content_tsv` column, the searcher must query the column instead of recomputing it
+CONTENT_TSVECTOR = "to_tsvector('english', coalesce(content, ''))"
+FULLTEXT_INDEX_NAME = "lse_doc_content_tsv_gin_idx"
+
+
+def create_fulltext_index(conn: Connection):
+    """
+    Adds the generated `content_tsv` column to lse_doc (which backfills every existing row) and its GIN index.
+    Safe to run repeatedly, rows inserted later are kept up to date by Postgres itself.
+    """
+    logger.info("Adding generated content_tsv column to lse_doc table...")
+    conn.execute(text(f'''
+        ALTER TABLE lse_doc
+        ADD COLUMN IF NOT EXISTS content_tsv TSVECTOR GENERATED ALWAYS AS ({CONTENT_TSVECTOR}) STORED;
+    '''))
+
+    logger.info(f"Creating GIN index {FULLTEXT_INDEX_NAME}...")
+    conn.execute(text(f'''
+        CREATE INDEX IF NOT EXISTS {FULLTEXT_INDEX_NAME} ON lse_doc USING GIN (content_tsv);
+    '''))
+
+    conn.commit()
+    logger.info("Full-text column and index created successfully.")
+
+
+#### Vector search ####
+
+EMBEDDING_COLUMNS = ["simple_embeddings", "title_embeddings", "context_embeddings"]
+# The searcher orders by `<=>` (cosine distance), the operator class must match it for the index to be used
+HNSW_OPCLASS = "vector_cosine_ops"
+# Old indexes shared one name and used inner product ops, so the planner could never use them for `<=>`
+LEGACY_HNSW_INDEX_NAME = "hnsw_index_for_innerproduct_doc_embedding"
+
+
+def hnsw_index_name(column: str) -> str:
+    return f"hnsw_index_for_cosine_{column}"
+
+
+def check_embedding_column(column: str):
+    if column not in EMBEDDING_COLUMNS:
+        raise ValueError(f"column must be in {EMBEDDING_COLUMNS}")
+
+
+def create_hnsw_index(conn: Connection, column: str, m: int = 16, ef_construction: int = 64, rebuild: bool = False):
+    """
+    Creates the cosine-distance HNSW index of one embedding column. With `rebuild`, an existing index is dropped
+    first so that new `m` / `ef_construction` values take effect.
+    """
+    check_embedding_column(column)
+    index_name = hnsw_index_name(column)
+
+    conn.execute(text(f"DROP INDEX IF EXISTS {LEGACY_HNSW_INDEX_NAME}"))
+    if rebuild:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index_name}"))
+
+    logger.info(f"Creating HNSW index {index_name} (m={m}, ef_construction={ef_construction})...")
+    conn.execute(text(f'''
+        CREATE INDEX IF NOT EXISTS {index_name} ON lse_doc
+        USING hnsw ({column} {HNSW_OPCLASS})
+        WITH (m = {int(m)}, ef_construction = {int(ef_construction)});
+    '''))
+
+    conn.commit()
+    logger.info(f"HNSW index {index_name} created successfully.")
+
+
+def explain_vector_query(conn: Connection, column: str, ef_search: int | None = None, limit: int = 20) -> tuple[bool, str]:
+    """
+    Runs EXPLAIN on the vector leg of the searcher's query, probing with an embedding taken from the table.
+    Returns whether the plan uses the HNSW index of `column`, and the plan itself.
+    """
+    check_embedding_column(column)
+
+    probe = conn.execute(text(f"SELECT {column}::text FROM lse_doc WHERE {column} IS NOT NULL LIMIT 1")).scalar()
+    if probe is None:
+        raise ValueError(f"No rows with {column} found, run the embedding script first")
+
+    if ef_search:
+        conn.execute(text(f"SET hnsw.ef_search = {int(ef_search)}"))
+
+    plan_rows = conn.execute(
+        text(f'''
+            EXPLAIN
+            SELECT id, RANK () OVER (ORDER BY {column} <=> CAST(:probe AS vector)) AS rank
+                FROM lse_doc
+                ORDER BY {column} <=> CAST(:probe AS vector)
+                LIMIT {int(limit)}
+        '''),
+        {"probe": probe},
+    ).fetchall()
+    plan = "\n".join(row[0] for row in plan_rows)
+
+    return hnsw_index_name(column) in plan, plan
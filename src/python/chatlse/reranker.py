@@ -0,0 +1,82 @@
+# This file contains the cross-encoder reranker used after retrieval
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from sentence_transformers import CrossEncoder
+
+from chatlse.embeddings import normalise_query
+from chatlse.lru import LRUCache
+
+logger = logging.getLogger("ragapp")
+
+RERANKER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+
+class Reranker:
+    """
+    Scores (query, chunk) pairs with a small cross-encoder on CPU. All pairs of one query are scored together in a
+    single batched forward pass on a dedicated worker thread, and scores are cached by (query hash, chunk id) so that
+    repeated queries only score the chunks they have not seen. Scores are between 0 and 1.
+    """
+    def __init__(self, model_name: str = RERANKER_MODEL, candidates: int = 20, cache_size: int = 10000, max_length: int = 512):
+        self.model_name = model_name
+        self.candidates = candidates # Number of chunks to retrieve before reranking
+        self.cache_size = cache_size
+        self.model = CrossEncoder(model_name, device="cpu", max_length=max_length)
+        # ms-marco cross-encoders output raw logits, squashed to (0, 1) so that score thresholds are comparable
+        self.activation = torch.nn.Sigmoid()
+        self._scores = LRUCache(cache_size) # (query hash, chunk id) -> score
+        self.hits = 0
+        self.misses = 0
+        # Single worker thread, for the same reason as EmbeddingService
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="reranker")
+
+    @staticmethod
+    def query_hash(query: str) -> str:
+        return hashlib.sha1(normalise_query(query).encode("utf-8")).hexdigest()
+
+    def _predict(self, pairs: list[list[str]]) -> list[float]:
+        scores = self.model.predict(pairs, batch_size=len(pairs), show_progress_bar=False, activation_fct=self.activation)
+        return [float(score) for score in scores]
+
+    async def rerank(self, query: str, docs: list, min_score: float | None = None) -> list[tuple]:
+        """
+        Returns (doc, score) pairs for the `docs` scoring at least `min_score` (all of them if None), best first.
+        """
+        query_hash = self.query_hash(query)
+        scores = {}
+        to_score = []
+        for doc in docs:
+            score = self._scores.get((query_hash, doc.id))
+            if score is not None:
+                scores[doc.id] = score
+                self.hits += 1
+            else:
+                to_score.append(doc)
+                self.misses += 1
+
+        if to_score:
+            new_scores = await asyncio.get_running_loop().run_in_executor(
+                self._executor, self._predict, [[query, doc.content] for doc in to_score]
+            )
+            for doc, score in zip(to_score, new_scores):
+                scores[doc.id] = score
+                self._scores.set((query_hash, doc.id), score)
+
+        ranked = sorted(((doc, scores[doc.id]) for doc in docs), key=lambda pair: pair[1], reverse=True)
+        return [(doc, score) for doc, score in ranked if min_score is None or score >= min_score]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._scores),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        self._executor.shutdown(wait=False)
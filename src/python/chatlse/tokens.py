@@ -0,0 +1,65 @@
+# This file contains util functions to count tokens of chunks at ingestion time
+import functools
+import logging
+
+import tiktoken
+from sqlalchemy import Connection, text
+
+logger = logging.getLogger("ragapp")
+
+# Encoding of the stored chunk token counts, the one openai_messages_token_helper falls back to for Ollama models
+CHUNK_TOKEN_ENCODING = "cl100k_base"
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoding(model: str | None = None) -> tiktoken.Encoding:
+    """
+    Returns the tiktoken encoding of `model`, or CHUNK_TOKEN_ENCODING for models tiktoken does not know.
+    """
+    if model:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            pass
+    return tiktoken.get_encoding(CHUNK_TOKEN_ENCODING)
+
+
+def count_tokens(text: str, encoding_name: str = CHUNK_TOKEN_ENCODING) -> int:
+    return len(tiktoken.get_encoding(encoding_name).encode(text))
+
+
+def format_chunk_for_rag(title: str, url: str, content: str, type: str) -> str:
+    """
+    Text of a chunk as it is put in the sources of the RAG prompt, the stored `token_count` is the count of this text.
+    """
+    return f"Title: {title} URL: {url} Content: {content} Type:{type}"
+
+
+def add_token_count_column(conn: Connection):
+    conn.execute(text("ALTER TABLE lse_doc ADD COLUMN IF NOT EXISTS token_count INTEGER;"))
+    conn.commit()
+
+
+def backfill_token_counts(conn: Connection, batch_size: int = 500):
+    """
+    Fills `token_count` for rows ingested before the column existed.
+    """
+    add_token_count_column(conn)
+    total = 0
+    while True:
+        rows = conn.execute(
+            text("SELECT id, title, url, content, type FROM lse_doc WHERE token_count IS NULL LIMIT :batch_size"),
+            {"batch_size": batch_size},
+        ).fetchall()
+        if not rows:
+            break
+        conn.execute(
+            text("UPDATE lse_doc SET token_count = :token_count WHERE id = :id"),
+            [
+                {"id": id, "token_count": count_tokens(format_chunk_for_rag(title, url, content, type))}
+                for id, title, url, content, type in rows
+            ],
+        )
+        conn.commit()
+        total += len(rows)
+        logger.info(f"Token counts filled for {total} chunks")